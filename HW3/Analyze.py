@@ -0,0 +1,223 @@
+# system libs
+import argparse
+import collections
+import json
+import math
+import multiprocessing as mp
+import sys
+import time
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Bitboard import Bitboard, ROWS, COLUMNS, CONNECT, board_geometry
+from Player import AIPlayer
+
+
+# the two AIPlayers of a pool worker by player number, and the budget,
+# set once per process by init_worker
+_players = {}
+_budget = (None, None)
+
+
+def parse_position(text, geometry):
+    """
+    Read one input line: either a string of 0 based column digits played
+    from the empty board, player 1 first, or rows * columns characters of
+    the board row by row from the top, '0' or '.' for an empty cell and '1'
+    or '2' for a piece
+
+    RETURNS:
+    (position, piece): the Bitboard and the player to move
+    """
+    rows, columns = geometry.rows, geometry.columns
+    if len(text) == rows * columns and set(text) <= set('.012'):
+        board = np.array([0 if c == '.' else int(c) for c in text], dtype=np.uint8).reshape(rows, columns)
+        ones = np.count_nonzero(board == 1)
+        twos = np.count_nonzero(board == 2)
+        if twos not in (ones, ones - 1):
+            raise ValueError('player 1 has {} pieces and player 2 {}'.format(ones, twos))
+        # no piece above an empty cell
+        filled = board != 0
+        if np.any(filled[:-1] & ~filled[1:]):
+            raise ValueError('floating piece')
+        position = Bitboard.from_array(board, geometry)
+        if position.is_win_mask(position.masks[0]) and position.is_win_mask(position.masks[1]):
+            raise ValueError('both players have won')
+        return position, 1 if ones == twos else 2
+
+    position = Bitboard(geometry)
+    for i, c in enumerate(text):
+        if not c.isdigit() or int(c) >= columns:
+            raise ValueError('bad column {!r} at move {}'.format(c, i + 1))
+        if position.num_moves() and position.game_completed():
+            raise ValueError('move {} comes after the end of the game'.format(i + 1))
+        if not position.can_play(int(c)):
+            raise ValueError('column {} is full at move {}'.format(c, i + 1))
+        position.make_move(int(c), 1 + i % 2)
+    return position, 1 + len(text) % 2
+
+
+def init_worker(size, time_limit, depth, table_mb, weights_path):
+    global _budget
+    rows, columns, connect = size
+    for piece in (1, 2):
+        _players[piece] = AIPlayer(piece, table_mb, rows=rows, columns=columns, connect=connect,
+                                   weights_path=weights_path, solver_mb=table_mb)
+    _budget = (time_limit, depth)
+
+
+def analyze(text):
+    """
+    Find the best move of one position with the worker's players
+
+    RETURNS:
+    A dict with the move, its score for the player to move, the depth
+    searched, where the move came from and the seconds taken, or with an
+    error
+    """
+    time_limit, depth = _budget
+    player = _players[1]
+    try:
+        position, piece = parse_position(text, player.geometry)
+    except ValueError as e:
+        return {'error': str(e)}
+    if position.game_completed():
+        return {'error': 'game over'}
+    player = _players[piece]
+    start = time.perf_counter()
+    player.search_depth = None
+    player.search_score = None
+    if depth is None:
+        move = player.get_alpha_beta_move(position.to_array(), time_limit)
+    else:
+        player.move_source = 'search'
+        player.start_search(position)
+        move = player.iterative_deepening(
+            position, lambda d: player.search_root(position, piece, d),
+            math.inf if time_limit is None else time_limit, max_depth=depth)
+    return {
+        'move': int(move),
+        'score': player.search_score,
+        'depth': player.search_depth,
+        'source': player.move_source,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def analyze_batch(batch):
+    """
+    Pool task: analyze consecutive input lines
+
+    INPUTS:
+    batch - a list of (line number, position text)
+
+    RETURNS:
+    One result dict per line, numbered and holding the input
+    """
+    results = []
+    for number, text in batch:
+        result = {'line': number, 'input': text}
+        result.update(analyze(text))
+        results.append(result)
+    return results
+
+
+def read_batches(lines, batch_size):
+    """
+    Group the input into lists of (line number, position text), skipping
+    comment lines starting with '#'; an empty line is the empty board
+    """
+    batch = []
+    for number, line in enumerate(lines, 1):
+        text = line.strip()
+        if text.startswith('#'):
+            continue
+        batch.append((number, text))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run(lines, out, workers=None, time_limit=None, depth=None, batch_size=1, window=None, table_mb=16,
+        weights_path=None, rows=ROWS, columns=COLUMNS, connect=CONNECT):
+    """
+    Analyze a stream of positions across a process pool and write one JSON
+    line per position to out, in input order, as soon as it and everything
+    before it is done. At most window batches are read ahead of the
+    output, so memory does not grow with the input.
+
+    INPUTS:
+    lines - an iterable of input lines, read lazily
+    out - a text file the results go to
+    workers - pool processes, default all cores
+    time_limit - seconds per position
+    depth - fixed search depth per position, stopped early by time_limit
+            if both are given; neither searches to the default depth
+    batch_size - positions per pool task
+    window - batches in flight, default 4 per worker
+    table_mb - transposition table size of every player, and the
+               endgame solver table size
+    weights_path - evaluation weights file of the players
+    rows, columns, connect - the board size and line length
+
+    RETURNS:
+    The number of positions written
+    """
+    # a bad board size fails here rather than in every worker
+    board_geometry(rows, columns, connect)
+    workers = workers or mp.cpu_count()
+    window = window or 4 * workers
+    pending = collections.deque()
+    written = 0
+    config = ((rows, columns, connect), time_limit, depth, table_mb, weights_path)
+    with mp.Pool(workers, init_worker, config) as pool:
+        batches = read_batches(lines, batch_size)
+        while True:
+            while len(pending) < window:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append(pool.apply_async(analyze_batch, (batch,)))
+            if not pending:
+                break
+            for result in pending.popleft().get():
+                out.write(json.dumps(result) + '\n')
+                written += 1
+            out.flush()
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Best moves and scores for a stream of positions')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='File of positions, one per line, default stdin: move strings like 3342 or '
+                             'rows*columns board characters (0 or ., 1, 2) from the top row')
+    parser.add_argument('--out', default='-', help='File for the JSON lines, default stdout')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, default all cores')
+    parser.add_argument('--time', type=float, default=None, help='Seconds per position')
+    parser.add_argument('--depth', type=int, default=None, help='Search depth per position')
+    parser.add_argument('--batch-size', type=int, default=1, help='Positions per pool task (int)')
+    parser.add_argument('--window', type=int, default=None, help='Pool tasks in flight, default 4 per worker')
+    parser.add_argument('--table-mb', type=int, default=16, help='Transposition table and endgame solver megabytes per player')
+    parser.add_argument('--weights', default=None, help='Evaluation weights file made by EvalTrainer.py')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Board rows (int)')
+    parser.add_argument('--columns', type=int, default=COLUMNS, help='Board columns (int)')
+    parser.add_argument('--connect', type=int, default=CONNECT, help='Pieces in a row that win (int)')
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == '-' else open(args.input)
+    out = sys.stdout if args.out == '-' else open(args.out, 'w')
+    try:
+        start = time.time()
+        count = run(source, out, args.workers, args.time, args.depth, args.batch_size, args.window, args.table_mb,
+                    args.weights, args.rows, args.columns, args.connect)
+        print('{} positions in {:.1f}s'.format(count, time.time() - start), file=sys.stderr)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if out is not sys.stdout:
+            out.close()
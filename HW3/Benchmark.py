@@ -0,0 +1,244 @@
+# system libs
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+# Local libs
+from Bitboard import Bitboard
+from Player import AIPlayer
+
+
+# fixed positions as the columns played from an empty board (player 1
+# moves first); none of them is decided or can be won with the next move
+CORPUS = {
+    'opening': ['', '3', '33', '3342'],
+    'midgame': ['325452130222', '56356414023212', '1046104562546000', '654103305314244160'],
+    'endgame': ['41460344543356556631633465', '2662116043143254102625515443',
+                '551060034163053132244415551033', '12010222615331146225546654415560'],
+}
+# (alpha-beta depth, expectimax depth) of every phase, deeper where the
+# tree is smaller
+SETTINGS = {
+    'opening': (7, 5),
+    'midgame': (8, 6),
+    'endgame': (12, 8),
+}
+# wall-clock seconds every throughput is measured for at least: a fixed
+# amount of work finishes too quickly on the small trees to be stable
+MIN_SECONDS = 0.5
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+
+def corpus_positions(phase):
+    """
+    RETURNS:
+    (Bitboard, player to move) for every position of the phase
+    """
+    positions = []
+    for moves in CORPUS[phase]:
+        positions.append((Bitboard.from_moves(moves), 1 + len(moves) % 2))
+    return positions
+
+
+def time_search(phase, depth, search, min_seconds=MIN_SECONDS):
+    """
+    Search every position of the phase at depths 1 to depth, each depth
+    with a fresh AIPlayer so the numbers do not depend on earlier searches.
+    The deepest search is repeated until it took min_seconds
+
+    INPUTS:
+    phase - a CORPUS key
+    depth - the deepest search
+    search - 'alpha_beta' or 'expectimax'
+    min_seconds - the least time the deepest search is measured for
+
+    RETURNS:
+    A dict with the nodes and seconds of one round of the deepest search,
+    its nodes per second and the seconds of one round to every depth
+    """
+    time_to_depth = {}
+    nodes = 0
+    seconds = 0
+    for d in range(1, depth + 1):
+        nodes = 0
+        seconds = 0
+        rounds = 0
+        while rounds == 0 or (d == depth and seconds < min_seconds):
+            for position, piece in corpus_positions(phase):
+                player = AIPlayer(piece, endgame_empty=0)
+                if search == 'alpha_beta':
+                    player.start_search(position)
+                    start = time.perf_counter()
+                    player.negamax(position, piece, d)
+                else:
+                    player.root_ply = len(position.history)
+                    player.evaluator.attach(position)
+                    start = time.perf_counter()
+                    player.expectimax_help(position, piece, d, True)
+                seconds += time.perf_counter() - start
+                nodes += player.nodes
+            rounds += 1
+        time_to_depth[d] = seconds / rounds
+    return {
+        'depth': depth,
+        'nodes': nodes // rounds,
+        'seconds': seconds / rounds,
+        'nodes_per_second': nodes / max(seconds, 1e-9),
+        'time_to_depth': time_to_depth,
+    }
+
+
+def calibrate(min_seconds=0.1, loops=20000):
+    """
+    RETURNS:
+    Loops per second of a fixed pure Python workload run for at least
+    min_seconds, a measure of how fast the machine runs Python right now
+    """
+    total = 0
+    start = time.perf_counter()
+    while total == 0 or time.perf_counter() - start < min_seconds:
+        x = 0
+        for i in range(loops):
+            x = (x * 31 + i) & 0xffffffff
+        total += loops
+    return total / (time.perf_counter() - start)
+
+
+def time_evaluation(phase, evaluator, min_seconds=MIN_SECONDS):
+    """
+    INPUTS:
+    phase - a CORPUS key
+    evaluator - 'evaluation_function' (numpy board) or 'evaluate_position'
+                (Bitboard)
+    min_seconds - the least time the evaluations are measured for
+
+    RETURNS:
+    A dict with the calls per second of the evaluator over the positions
+    of the phase
+    """
+    positions = corpus_positions(phase)
+    if evaluator == 'evaluation_function':
+        positions = [(position.to_array(), piece) for position, piece in positions]
+    players = {piece: AIPlayer(piece, endgame_empty=0) for piece in (1, 2)}
+    evaluate = {piece: getattr(player, evaluator) for piece, player in players.items()}
+
+    rounds = 0
+    start = time.perf_counter()
+    while rounds == 0 or time.perf_counter() - start < min_seconds:
+        for position, piece in positions:
+            evaluate[piece](position)
+        rounds += 1
+    return {'calls_per_second': rounds * len(positions) / (time.perf_counter() - start)}
+
+
+def run_benchmark(repeat=5, min_seconds=MIN_SECONDS):
+    """
+    Run every measurement repeat times and keep the median one, by its
+    calibrated throughput, which one disturbed run cannot move
+
+    RETURNS:
+    The results as a dict, by phase
+    """
+    results = {}
+    for phase in CORPUS:
+        alpha_beta_depth, expectimax_depth = SETTINGS[phase]
+        runs = {}
+        for _ in range(repeat):
+            measurements = (
+                ('alpha_beta', lambda: time_search(phase, alpha_beta_depth, 'alpha_beta', min_seconds)),
+                ('expectimax', lambda: time_search(phase, expectimax_depth, 'expectimax', min_seconds)),
+                ('evaluation_function', lambda: time_evaluation(phase, 'evaluation_function', min_seconds)),
+                ('evaluate_position', lambda: time_evaluation(phase, 'evaluate_position', min_seconds)),
+            )
+            for name, measure in measurements:
+                # calibrate around every measurement, so a change in machine
+                # speed during the run is matched to the right numbers
+                speed = calibrate()
+                value = measure()
+                value['calibration'] = (speed + calibrate()) / 2
+                runs.setdefault(name, []).append(value)
+        results[phase] = {name: sorted(values, key=rate)[len(values) // 2] for name, values in runs.items()}
+    return results
+
+
+def rate(value):
+    """
+    RETURNS:
+    The throughput of one measurement divided by its calibration speed
+    """
+    return next(number for key, number in value.items() if key.endswith('per_second')) / value['calibration']
+
+
+def throughputs(phase_result, normalize=False):
+    """
+    RETURNS:
+    The throughput numbers (higher is better) of one phase, by name. With
+    normalize they are divided by the calibration speed they were measured
+    at, which makes runs on a faster or slower machine comparable
+    """
+    found = {}
+    for name, value in phase_result.items():
+        for key, number in value.items():
+            if key.endswith('per_second'):
+                found[name + '.' + key] = number / value['calibration'] if normalize else number
+    return found
+
+
+def compare(results, baseline, threshold):
+    """
+    RETURNS:
+    A line for every throughput that dropped more than threshold (a
+    fraction) below the baseline, both normalized by their calibration
+    """
+    failures = []
+    for phase, phase_result in results.items():
+        if phase not in baseline:
+            continue
+        old = throughputs(baseline[phase], normalize=True)
+        new = throughputs(phase_result)
+        for name, number in throughputs(phase_result, normalize=True).items():
+            if name in old and number < old[name] * (1 - threshold):
+                failures.append('{} {}: {:.0f}/s, {:+.0%} against the baseline'.format(
+                    phase, name, new[name], number / old[name] - 1))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure search and evaluation speed on a fixed corpus')
+    parser.add_argument('--out', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Fail when a throughput drops by more than this fraction (float)')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement, the median is kept (int)')
+    parser.add_argument('--min-seconds', type=float, default=MIN_SECONDS,
+                        help='Least seconds every measurement runs for (float)')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repeat, args.min_seconds)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    for phase, phase_result in results.items():
+        for name, number in sorted(throughputs(phase_result).items()):
+            print('{:<9}{:<45}{:>12.0f}'.format(phase, name, number))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        failures = compare(results, baseline, args.threshold)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        if failures:
+            sys.exit(1)
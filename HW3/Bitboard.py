@@ -0,0 +1,344 @@
+import random
+
+import numpy as np
+
+
+# bitboard layout (credit to http://blog.gamesolver.org/solving-connect-four/06-bitboard/):
+# every column takes rows + 1 bits, the lowest bit is the bottom cell and the
+# extra top bit is always 0, so shifting by a whole column never wraps into
+# the next one.
+#
+#   6 13 20 27 34 41 48
+#   5 12 19 26 33 40 47
+#   4 11 18 25 32 39 46
+#   3 10 17 24 31 38 45
+#   2  9 16 23 30 37 44
+#   1  8 15 22 29 36 43
+#   0  7 14 21 28 35 42
+ROWS = 6
+COLUMNS = 7
+CONNECT = 4
+
+
+def _build_windows(rows, columns, n):
+    """
+    Every group of n cells in a line as a bit mask, the same windows
+    that AIPlayer.evaluation_function slides over
+    """
+    h1 = rows + 1
+    windows = []
+    for dc, dr in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        for c in range(columns):
+            for r in range(rows):
+                end_c, end_r = c + dc * (n - 1), r + dr * (n - 1)
+                if end_c >= columns or not 0 <= end_r < rows:
+                    continue
+                mask = 0
+                for i in range(n):
+                    mask |= 1 << ((c + dc * i) * h1 + r + dr * i)
+                windows.append(mask)
+    return windows
+
+
+def _build_popcount(windows):
+    """
+    Number of set bits of every subset of every window, a dict lookup is
+    much cheaper than bin(x).count('1') in the evaluator's inner loop
+    """
+    popcount = {}
+    for window in windows:
+        bits = [1 << i for i in range(window.bit_length()) if window >> i & 1]
+        for subset in range(1 << len(bits)):
+            mask = 0
+            for i, bit in enumerate(bits):
+                if subset >> i & 1:
+                    mask |= bit
+            popcount[mask] = bin(subset).count('1')
+    return popcount
+
+
+def _build_win_steps(n):
+    """
+    Shifts, in units of the line direction, that reduce a mask to the cells
+    starting a line of n: each step and-s the mask with itself shifted, so
+    runs of k become runs of 2k, and a last step fills up to n
+    """
+    steps = []
+    run = 1
+    while 2 * run <= n:
+        steps.append(run)
+        run *= 2
+    if run < n:
+        steps.append(n - run)
+    return steps
+
+
+class Geometry:
+    def __init__(self, rows, columns, connect):
+        """
+        The precomputed tables of one board size and line length. Build it
+        with board_geometry(), which keeps one per size, so the tables are made
+        once per process and never during a search
+
+        INPUTS:
+        rows, columns - the board size
+        connect - how many pieces in a line win
+        """
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.h1 = rows + 1
+        self.num_bits = columns * (rows + 1)
+        # direction shifts: vertical, horizontal, both diagonals
+        self.shifts = (1, self.h1, self.h1 - 1, self.h1 + 1)
+        self.win_steps = _build_win_steps(connect)
+        self.windows = _build_windows(rows, columns, connect)
+        self.popcount = _build_popcount(self.windows)
+        # the windows through every cell, lines_through[bit]: a move can
+        # only win with one of these
+        self.lines_through = [[w for w in self.windows if w >> bit & 1] for bit in range(self.num_bits)]
+        # every playable cell
+        self.board_mask = sum(((1 << rows) - 1) << (c * self.h1) for c in range(columns))
+        # zobrist keys, zobrist[piece - 1][bit]; fixed seed so hashes are
+        # the same in every process
+        rng = random.Random(240)
+        self.zobrist = [[rng.getrandbits(64) for _ in range(self.num_bits)] for _ in range(2)]
+
+    # a copy sent to another process is the cached one of that process
+    def __reduce__(self):
+        return board_geometry, (self.rows, self.columns, self.connect)
+
+
+# Geometry by (rows, columns, connect)
+_geometries = {}
+
+
+def board_geometry(rows=ROWS, columns=COLUMNS, connect=CONNECT):
+    """
+    RETURNS:
+    The Geometry of the board size, the same object for every call
+    """
+    key = (rows, columns, connect)
+    if key not in _geometries:
+        if rows < 1 or columns < 1 or connect < 2 or connect > max(rows, columns):
+            raise ValueError('no {}-in-a-row on a {}x{} board'.format(connect, rows, columns))
+        _geometries[key] = Geometry(rows, columns, connect)
+    return _geometries[key]
+
+
+# the tables of the standard 6x7 connect-4 board
+STANDARD = board_geometry()
+WINDOWS = STANDARD.windows
+POPCOUNT = STANDARD.popcount
+LINES_THROUGH = STANDARD.lines_through
+BOARD_MASK = STANDARD.board_mask
+ZOBRIST = STANDARD.zobrist
+
+
+class Bitboard:
+    def __init__(self, geometry=STANDARD):
+        self.geometry = geometry
+        self.rows = geometry.rows
+        self.columns = geometry.columns
+        self.zobrist = geometry.zobrist
+        # one mask per player, masks[piece - 1]
+        self.masks = [0, 0]
+        # bit index of the next free cell in each column
+        self.heights = [c * geometry.h1 for c in range(geometry.columns)]
+        self.history = []
+        # zobrist hash of the position, updated incrementally by make/unmake
+        self.hash = 0
+        # an IncrementalEvaluator following the moves, see its attach
+        self.evaluator = None
+
+    @classmethod
+    def from_array(cls, board, geometry=None):
+        """
+        Build a bitboard from the numpy board that Game passes to the players
+
+        INPUTS:
+        board - a numpy array, row 0 is the top of the board, 0 is an empty
+                space and 1 or 2 is a piece of that player
+        geometry - the Geometry of the board, default the board's size with
+                   CONNECT in a row
+
+        RETURNS:
+        A new Bitboard holding the same position
+        """
+        if geometry is None:
+            geometry = board_geometry(board.shape[0], board.shape[1])
+        position = cls(geometry)
+        for c in range(position.columns):
+            for r in range(position.rows - 1, -1, -1):
+                piece = int(board[r][c])
+                if piece == 0:
+                    break
+                position.masks[piece - 1] |= 1 << position.heights[c]
+                position.hash ^= position.zobrist[piece - 1][position.heights[c]]
+                position.heights[c] += 1
+        return position
+
+    @classmethod
+    def from_moves(cls, moves, geometry=STANDARD):
+        """
+        Build a bitboard by playing moves from an empty board
+
+        INPUTS:
+        moves - a string of 0 based column digits, player 1 moves first
+        geometry - the Geometry of the board
+
+        RETURNS:
+        A new Bitboard holding the position after the moves
+        """
+        position = cls(geometry)
+        for i, col in enumerate(moves):
+            position.make_move(int(col), 1 + i % 2)
+        return position
+
+    def to_array(self):
+        """
+        RETURNS:
+        The position as a numpy uint8 array in the encoding Game uses
+        """
+        board = np.zeros([self.rows, self.columns]).astype(np.uint8)
+        h1 = self.rows + 1
+        for c in range(self.columns):
+            for r in range(self.rows):
+                bit = 1 << (c * h1 + r)
+                if self.masks[0] & bit:
+                    board[self.rows - 1 - r][c] = 1
+                elif self.masks[1] & bit:
+                    board[self.rows - 1 - r][c] = 2
+        return board
+
+    def copy(self):
+        position = Bitboard(self.geometry)
+        position.masks = list(self.masks)
+        position.heights = list(self.heights)
+        position.history = list(self.history)
+        position.hash = self.hash
+        return position
+
+    def occupied(self):
+        return self.masks[0] | self.masks[1]
+
+    def can_play(self, col):
+        return self.heights[col] < col * (self.rows + 1) + self.rows
+
+    def valid_columns(self):
+        return [c for c in range(self.columns) if self.can_play(c)]
+
+    def num_moves(self):
+        return bin(self.occupied()).count('1')
+
+    def make_move(self, col, piece):
+        bit = self.heights[col]
+        self.masks[piece - 1] |= 1 << bit
+        self.hash ^= self.zobrist[piece - 1][bit]
+        self.heights[col] += 1
+        self.history.append((col, piece))
+        if self.evaluator is not None:
+            self.evaluator.add(bit, piece)
+
+    def unmake_move(self):
+        col, piece = self.history.pop()
+        self.heights[col] -= 1
+        bit = self.heights[col]
+        self.masks[piece - 1] ^= 1 << bit
+        self.hash ^= self.zobrist[piece - 1][bit]
+        if self.evaluator is not None:
+            self.evaluator.remove(bit, piece)
+        return col
+
+    def has_won(self, piece):
+        return self.is_win_mask(self.masks[piece - 1])
+
+    def is_winning_move(self, col, piece):
+        """
+        RETURNS:
+        True if piece playing col wins, without making the move
+        """
+        bit = self.heights[col]
+        mask = self.masks[piece - 1] | 1 << bit
+        for window in self.geometry.lines_through[bit]:
+            if mask & window == window:
+                return True
+        return False
+
+    def opponent_wins_after(self, col, piece):
+        """
+        RETURNS:
+        True if the opponent of piece has a winning move once piece has
+        played col, without making the move
+        """
+        mask = self.masks[2 - piece]
+        h1 = self.rows + 1
+        lines_through = self.geometry.lines_through
+        for c in range(self.columns):
+            bit = self.heights[c] + (c == col)
+            if bit < c * h1 + self.rows:
+                with_move = mask | 1 << bit
+                for window in lines_through[bit]:
+                    if with_move & window == window:
+                        return True
+        return False
+
+    def wins_on_top(self, col, piece):
+        """
+        RETURNS:
+        True if piece would win with the cell above the next free cell of
+        col, so the other player must not play col
+        """
+        bit = self.heights[col] + 1
+        if bit >= col * (self.rows + 1) + self.rows:
+            return False
+        mask = self.masks[piece - 1] | 1 << bit
+        for window in self.geometry.lines_through[bit]:
+            if mask & window == window:
+                return True
+        return False
+
+    def last_move_won(self):
+        """
+        RETURNS:
+        True if the last move made a line. Only the lines through the last
+        piece are looked at, so an earlier win is not seen; the search
+        never plays on in a won position
+        """
+        col, piece = self.history[-1]
+        mask = self.masks[piece - 1]
+        for window in self.geometry.lines_through[self.heights[col] - 1]:
+            if mask & window == window:
+                return True
+        return False
+
+    def winner(self):
+        """
+        RETURNS:
+        The player number that has a line, 0 if neither has
+        """
+        if self.history:
+            return self.history[-1][1] if self.last_move_won() else 0
+        if self.has_won(1):
+            return 1
+        return 2 if self.has_won(2) else 0
+
+    def is_win_mask(self, mask):
+        steps = self.geometry.win_steps
+        # vertical, horizontal, both diagonals
+        for shift in self.geometry.shifts:
+            m = mask
+            for step in steps:
+                m &= m >> (step * shift)
+            if m:
+                return True
+        return False
+
+    def is_full(self):
+        return (self.masks[0] | self.masks[1]) == self.geometry.board_mask
+
+    def game_completed(self):
+        if self.history:
+            return self.last_move_won() or (self.masks[0] | self.masks[1]) == self.geometry.board_mask
+        # a position from from_array has no last move, look at every line
+        return self.has_won(1) or self.has_won(2) or self.is_full()
@@ -1,160 +1,293 @@
 # system libs
 import argparse
 import multiprocessing as mp
+import queue
+import time
 import tkinter as tk
 
 # 3rd party libs
 import numpy as np
 
 # Local libs
+from Bitboard import ROWS, COLUMNS, CONNECT
 from Player import AIPlayer, RandomPlayer, HumanPlayer
+from Rules import drop_piece, search_method, won_at
 
-#https://stackoverflow.com/a/37737985
-def turn_worker(board, send_end, p_func):
-    send_end.send(p_func(board))
+# milliseconds between checks for the move of a thinking AI worker
+POLL_MS = 50
+# milliseconds autoplay waits after a move before asking for the next one
+AUTOPLAY_DELAY_MS = 500
+
+
+def ai_worker(player, requests, results, ponder=False):
+    """
+    Runs in the AIWorker process: answers move requests with the same
+    player object for the whole game, so its tables survive between turns.
+    With ponder it keeps searching after an alpha-beta move until the next
+    request comes in
+    """
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        board, method, deadline = request
+        try:
+            # the search gets whatever is left of the turn once the request is in
+            move = getattr(player, method)(board, deadline - time.time())
+        except Exception as e:
+            results.put((None, repr(e)))
+            continue
+        results.put((move, None))
+        # expectimax plays a random opponent, whose move can not be guessed
+        if ponder and method == 'get_alpha_beta_move':
+            board = board.copy()
+            drop_piece(board, int(move), player.player_number)
+            player.ponder(board, lambda: not requests.empty())
+
+
+class AIWorker:
+    def __init__(self, player, ponder=False):
+        """
+        A long-lived process that plays for one AIPlayer
+
+        INPUTS:
+        player - the AIPlayer, copied into the process once
+        ponder - search on the opponent's time between moves
+        """
+        self.player_number = player.player_number
+        self.requests = mp.Queue()
+        self.results = mp.Queue()
+        # a daemon process can not start the Lazy SMP helpers of its player
+        self.process = mp.Process(target=ai_worker, args=(player, self.requests, self.results, ponder),
+                                  daemon=not player.smp_workers)
+        self.process.start()
+
+    def request_move(self, board, method, deadline, time_limit):
+        """
+        Ask the worker for a move without waiting for it, poll collects it
+
+        INPUTS:
+        board - the numpy board
+        method - 'get_alpha_beta_move', 'get_expectimax_move' or
+                 'get_mcts_move'
+        deadline - wall-clock time the search should stop at
+        time_limit - seconds to wait before the worker is killed
+        """
+        self.requests.put((board, method, deadline))
+        self.give_up = time.time() + time_limit
+
+    def poll(self):
+        """
+        Check for the answer to request_move without waiting; the worker
+        is killed if it has not answered by the time limit or if it died
+
+        RETURNS:
+        The column the player chose, None while it is still thinking
+        """
+        try:
+            move, error = self.results.get_nowait()
+        except queue.Empty:
+            if not self.process.is_alive():
+                raise Exception('Player process died')
+            if time.time() >= self.give_up:
+                self.process.terminate()
+                self.process.join()
+                raise Exception('Player Exceeded time limit')
+            return None
+        if error is not None:
+            raise Exception(error)
+        return move
+
+    def close(self):
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
 
 
 class Game:
-    def __init__(self, player1, player2, time):
+    def __init__(self, player1, player2, time, rows=ROWS, columns=COLUMNS, connect=CONNECT, ponder=False,
+                 autoplay=False):
+        """
+        The game window. An AI turn runs in its AIWorker while the window
+        keeps handling events: the worker is polled every POLL_MS and the
+        move drawn as soon as it arrives. With autoplay every AI and random
+        turn follows the last one without a click on 'Next Move'; it stops
+        at a human's turn
+
+        INPUTS:
+        player1, player2 - AIPlayer, RandomPlayer or HumanPlayer objects
+        time - seconds an AI player has for a move
+        rows, columns, connect - the board size and the pieces in a row that win
+        ponder - let the AI players think on their opponent's time
+        autoplay - start with autoplay on
+        """
         self.players = [player1, player2]
         self.colors = ['yellow', 'red']
         self.current_turn = 0
-        self.board = np.zeros([6,7]).astype(np.uint8)
+        self.connect = connect
+        self.board = np.zeros([rows, columns]).astype(np.uint8)
         self.gui_board = []
         self.game_over = False
+        # (row, column) of the last piece dropped, the only place a win can be
+        self.last_move = None
         self.ai_turn_limit = time
+        # part of the turn kept back for sending the board and the move
+        self.ai_turn_margin = min(1.0, 0.2 * time)
+        # one long-lived search process per AI player, keyed by player number
+        self.ai_workers = {}
+        for player in self.players:
+            if player.type == 'ai':
+                self.ai_workers[player.player_number] = AIWorker(player, ponder)
+        # the worker of the AI player thinking right now, None between turns
+        self.thinking = None
+        # the Tk after id of the next autoplay move, None if none is due
+        self.autoplay_job = None
 
         #https://stackoverflow.com/a/38159672
-        root = tk.Tk()
-        root.title('Connect 4')
-        self.player_string = tk.Label(root, text=player1.player_string)
+        self.root = tk.Tk()
+        self.root.title('Connect 4')
+        self.player_string = tk.Label(self.root, text=player1.player_string)
         self.player_string.pack()
-        self.c = tk.Canvas(root, width=700, height=600)
+        self.c = tk.Canvas(self.root, width=100*columns, height=100*rows)
         self.c.pack()
 
-        for row in range(0, 700, 100):
+        # gui_board[col][row], row 0 on top like the board
+        for x in range(0, 100*columns, 100):
             column = []
-            for col in range(0, 700, 100):
-                column.append(self.c.create_oval(row, col, row+100, col+100, fill=''))
+            for y in range(0, 100*rows, 100):
+                column.append(self.c.create_oval(x, y, x+100, y+100, fill=''))
             self.gui_board.append(column)
 
-        tk.Button(root, text='Next Move', command=self.make_move).pack()
+        tk.Button(self.root, text='Next Move', command=self.make_move).pack()
+        self.autoplay = tk.BooleanVar(self.root, value=autoplay)
+        tk.Checkbutton(self.root, text='Autoplay', variable=self.autoplay, command=self.schedule_autoplay).pack()
+        self.schedule_autoplay()
 
-        root.mainloop()
+        self.root.mainloop()
+        self.close_workers()
 
     def make_move(self):
-        if not self.game_over:
-            current_player = self.players[self.current_turn]
-
-            if current_player.type == 'ai':
-                
-                if self.players[int(not self.current_turn)].type == 'random':
-                    p_func = current_player.get_expectimax_move
-                else:
-                    p_func = current_player.get_alpha_beta_move
-                
-                try:
-                    recv_end, send_end = mp.Pipe(False)
-                    p = mp.Process(target=turn_worker, args=(self.board, send_end, p_func))
-                    p.start()
-                    if p.join(self.ai_turn_limit) is None and p.is_alive():
-                        p.terminate()
-                        raise Exception('Player Exceeded time limit')
-                except Exception as e:
-                    uh_oh = 'Uh oh.... something is wrong with Player {}'
-                    print(uh_oh.format(current_player.player_number))
-                    print(e)
-                    raise Exception('Game Over')
-
-                move = recv_end.recv()
-            else:
-                move = current_player.get_move(self.board)
-
-            if move is not None:
-                self.update_board(int(move), current_player.player_number)
-
-            if self.game_completed(current_player.player_number):
-                self.game_over = True
-                self.player_string.configure(text=self.players[self.current_turn].player_string + ' wins!')
-            else:
-                self.current_turn = int(not self.current_turn)
-                self.player_string.configure(text=self.players[self.current_turn].player_string)
-
-    def update_board(self, move, player_num):
-        if 0 in self.board[:,move]:
-            update_row = -1
-            for row in range(1, self.board.shape[0]):
-                update_row = -1
-                if self.board[row, move] > 0 and self.board[row-1, move] == 0:
-                    update_row = row-1
-                elif row==self.board.shape[0]-1 and self.board[row, move] == 0:
-                    update_row = row
-
-                if update_row >= 0:
-                    self.board[update_row, move] = player_num
-                    self.c.itemconfig(self.gui_board[move][update_row],
-                                      fill=self.colors[self.current_turn])
-                    break
+        if self.game_over or self.thinking is not None:
+            return
+        current_player = self.players[self.current_turn]
+
+        if current_player.type == 'ai':
+            method = search_method(self.players[int(not self.current_turn)].type, current_player.engine)
+            deadline = time.time() + self.ai_turn_limit - self.ai_turn_margin
+            self.thinking = self.ai_workers[current_player.player_number]
+            self.thinking.request_move(self.board, method, deadline, self.ai_turn_limit)
+            self.player_string.configure(text=current_player.player_string + ' thinking...')
+            self.root.after(POLL_MS, self.poll_ai)
         else:
-            err = 'Invalid move by player {}. Column {}'.format(player_num, move)
-            raise Exception(err)
+            self.play(current_player.get_move(self.board))
+
+    def poll_ai(self):
+        current_player = self.players[self.current_turn]
+        try:
+            move = self.thinking.poll()
+        except Exception as e:
+            uh_oh = 'Uh oh.... something is wrong with Player {}'
+            print(uh_oh.format(current_player.player_number))
+            print(e)
+            # a timed out or broken AI forfeits, the game cannot go on
+            self.thinking = None
+            self.game_over = True
+            self.close_workers()
+            opponent = self.players[int(not self.current_turn)]
+            self.player_string.configure(text='{} forfeits, {} wins!'.format(
+                current_player.player_string, opponent.player_string))
+            return
+        if move is None:
+            self.root.after(POLL_MS, self.poll_ai)
+            return
+        self.thinking = None
+        self.play(move)
+
+    def play(self, move):
+        """
+        Draw the move of the player whose turn it is and pass the turn on
+        """
+        current_player = self.players[self.current_turn]
+        if move is not None:
+            self.update_board(int(move), current_player.player_number)
+
+        if self.game_completed(current_player.player_number):
+            self.game_over = True
+            self.close_workers()
+            self.player_string.configure(text=current_player.player_string + ' wins!')
+        elif 0 not in self.board[0]:
+            self.game_over = True
+            self.close_workers()
+            self.player_string.configure(text='Draw')
+        else:
+            self.current_turn = int(not self.current_turn)
+            self.player_string.configure(text=self.players[self.current_turn].player_string)
+            self.schedule_autoplay()
+
+    def schedule_autoplay(self):
+        """
+        Schedule the next move if autoplay is on and the player to move
+        needs no click; a move already scheduled is not doubled
+        """
+        if (self.autoplay.get() and self.autoplay_job is None and not self.game_over
+                and self.players[self.current_turn].type != 'human'):
+            self.autoplay_job = self.root.after(AUTOPLAY_DELAY_MS, self.autoplay_move)
+
+    def autoplay_move(self):
+        self.autoplay_job = None
+        if self.autoplay.get():
+            self.make_move()
+
+    def close_workers(self):
+        for worker in self.ai_workers.values():
+            worker.close()
+        self.ai_workers = {}
 
+    def update_board(self, move, player_num):
+        update_row = drop_piece(self.board, move, player_num)
+        self.last_move = (update_row, move)
+        self.c.itemconfig(self.gui_board[move][update_row],
+                          fill=self.colors[self.current_turn])
 
     def game_completed(self, player_num):
-        player_win_str = '{0}{0}{0}{0}'.format(player_num)
-        board = self.board
-        to_str = lambda a: ''.join(a.astype(str))
-
-        def check_horizontal(b):
-            for row in b:
-                if player_win_str in to_str(row):
-                    return True
+        if self.last_move is None:
             return False
-
-        def check_verticle(b):
-            return check_horizontal(b.T)
-
-        def check_diagonal(b):
-            for op in [None, np.fliplr]:
-                op_board = op(b) if op else b
-                
-                root_diag = np.diagonal(op_board, offset=0).astype(np.int)
-                if player_win_str in to_str(root_diag):
-                    return True
-
-                for i in range(1, b.shape[1]-3):
-                    for offset in [i, -i]:
-                        diag = np.diagonal(op_board, offset=offset)
-                        diag = to_str(diag.astype(np.int))
-                        if player_win_str in diag:
-                            return True
-
-            return False
-
-        return (check_horizontal(board) or
-                check_verticle(board) or
-                check_diagonal(board))
-
+        row, col = self.last_move
+        return won_at(self.board, row, col, player_num, self.connect)
 
 
-def main(player1, player2, time):
+def main(player1, player2, time, book=None, rows=ROWS, columns=COLUMNS, connect=CONNECT, ponder=False, weights=None,
+         smp_workers=0, autoplay=False):
     """
     Creates player objects based on the string paramters that are passed
     to it and calls play_game()
 
     INPUTS:
-    player1 - a string ['ai', 'random', 'human']
-    player2 - a string ['ai', 'random', 'human']
+    player1 - a string ['ai', 'mcts', 'random', 'human']
+    player2 - a string ['ai', 'mcts', 'random', 'human']
+    book - path of an opening book file for the ai players, or None
+    rows, columns - the board size
+    connect - how many pieces in a row win
+    ponder - let the ai players think on their opponent's time
+    weights - path of an evaluation weights file for the ai players, or
+              None for the built-in weights
+    smp_workers - Lazy SMP helper processes of every ai player
+    autoplay - play the ai and random turns without clicking 'Next Move'
     """
     def make_player(name, num):
         if name=='ai':
-            return AIPlayer(num)
+            return AIPlayer(num, book_path=book, rows=rows, columns=columns, connect=connect, weights_path=weights,
+                            smp_workers=smp_workers)
+        elif name=='mcts':
+            return AIPlayer(num, rows=rows, columns=columns, connect=connect, engine='mcts')
         elif name=='random':
             return RandomPlayer(num)
         elif name=='human':
             return HumanPlayer(num)
 
-    Game(make_player(player1, 1), make_player(player2, 2), time)
+    Game(make_player(player1, 1), make_player(player2, 2), time, rows, columns, connect, ponder, autoplay)
 
 
 def play_game(player1, player2):
@@ -173,7 +306,7 @@ def play_game(player1, player2):
 
 
 if __name__=='__main__':
-    player_types = ['ai', 'random', 'human']
+    player_types = ['ai', 'mcts', 'random', 'human']
     parser = argparse.ArgumentParser()
     parser.add_argument('player1', choices=player_types)
     parser.add_argument('player2', choices=player_types)
@@ -181,6 +314,19 @@ if __name__=='__main__':
                         type=int,
                         default=60,
                         help='Time to wait for a move in seconds (int)')
+    parser.add_argument('--book',
+                        default=None,
+                        help='Opening book file made by OpeningBook.py')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Board rows (int)')
+    parser.add_argument('--columns', type=int, default=COLUMNS, help='Board columns (int)')
+    parser.add_argument('--connect', type=int, default=CONNECT, help='Pieces in a row that win (int)')
+    parser.add_argument('--ponder', action='store_true', help="Let ai players think on the opponent's time")
+    parser.add_argument('--weights', default=None, help='Evaluation weights file made by EvalTrainer.py')
+    parser.add_argument('--smp-workers', type=int, default=0,
+                        help='Helper processes searching with every ai player (Lazy SMP), 0 for none')
+    parser.add_argument('--autoplay', action='store_true',
+                        help="Play the ai and random turns without clicking 'Next Move'")
     args = parser.parse_args()
 
-    main(args.player1, args.player2, args.time)
\ No newline at end of file
+    main(args.player1, args.player2, args.time, args.book, args.rows, args.columns, args.connect, args.ponder,
+         args.weights, args.smp_workers, args.autoplay)
\ No newline at end of file
@@ -0,0 +1,292 @@
+# system libs
+import argparse
+import random
+import time
+
+# Local libs
+from Bitboard import Bitboard, ROWS, COLUMNS
+from MoveOrdering import center_order
+
+
+# scores follow http://blog.gamesolver.org/solving-connect-four/02-test-protocol/:
+# 0 is a draw, a win with the k-th last own stone scores k, a loss -k. So
+# the sooner a game is won the higher the score
+SIZE = ROWS * COLUMNS
+H1 = ROWS + 1
+BOTTOM_MASK = sum(1 << (c * H1) for c in range(COLUMNS))
+BOARD_MASK = BOTTOM_MASK * ((1 << ROWS) - 1)
+COLUMN_MASKS = [((1 << ROWS) - 1) << (c * H1) for c in range(COLUMNS)]
+ORDER = center_order(COLUMNS)
+# rough size of one table entry in bytes (dict slot, int key and bounds
+# tuple), used to turn the memory cap into a number of entries
+SOLVER_ENTRY_BYTES = 165
+
+
+def winning_cells(own, mask):
+    """
+    RETURNS:
+    The empty cells that would complete a line of four for the stones own
+    """
+    # vertical
+    r = (own << 1) & (own << 2) & (own << 3)
+    # horizontal and both diagonals
+    for shift in (H1, H1 - 1, H1 + 1):
+        p = (own << shift) & (own << 2 * shift)
+        r |= p & (own << 3 * shift)
+        r |= p & (own >> shift)
+        p = (own >> shift) & (own >> 2 * shift)
+        r |= p & (own << shift)
+        r |= p & (own >> 3 * shift)
+    return r & (BOARD_MASK ^ mask)
+
+
+def popcount(x):
+    return bin(x).count('1')
+
+
+def score_to_plies(score, moves):
+    """
+    RETURNS:
+    How many plies from the position with moves stones the game ends with
+    perfect play, None for a draw
+    """
+    if score == 0:
+        return None
+    # the winner wins with its own stone number SIZE // 2 + 1 - |score|,
+    # which is stone number SIZE + 2 - 2 * |score| of the game for player 2
+    # and the one before for player 1, who moves first
+    stone = SIZE + 2 - 2 * abs(score)
+    if (score > 0) == (moves % 2 == 0):
+        stone -= 1
+    return stone - moves
+
+
+class EndgameSolver:
+    def __init__(self, size_mb=16):
+        """
+        Exact negamax solver with null-window search, alpha-beta on a
+        transposition table of score bounds, and only moves that do not
+        hand the opponent an immediate win
+
+        INPUTS:
+        size_mb - approximate memory cap of the table in megabytes, it is
+                  emptied when it grows past this size
+        """
+        self.max_entries = max(1, size_mb * 1024 * 1024 // SOLVER_ENTRY_BYTES)
+        # (stones of the side to move + all stones) -> (lower, upper)
+        self.table = {}
+        self.nodes = 0
+        self.check_time = None
+
+    def non_losing_moves(self, own, mask):
+        """
+        RETURNS:
+        The cells (one bit per column) the side to move can play without
+        the opponent winning at once, 0 if every move loses
+        """
+        possible = (mask + BOTTOM_MASK) & BOARD_MASK
+        opponent_win = winning_cells(own ^ mask, mask)
+        forced = possible & opponent_win
+        if forced:
+            if forced & (forced - 1):
+                # two threats, only one can be blocked
+                return 0
+            possible = forced
+        # never play right below an opponent winning cell
+        return possible & ~(opponent_win >> 1)
+
+    def negamax(self, own, mask, moves, alpha, beta):
+        """
+        INPUTS:
+        own - the stones of the side to move, which can not win at once
+        mask - all stones
+        moves - the number of stones
+        alpha, beta - the score window
+
+        RETURNS:
+        The exact score inside (alpha, beta), otherwise a bound on the
+        side of the window it fell on
+        """
+        self.nodes += 1
+        if self.check_time is not None and not self.nodes & 1023:
+            self.check_time()
+        moves_left = self.non_losing_moves(own, mask)
+        if not moves_left:
+            return -((SIZE - moves) // 2)
+        if moves >= SIZE - 2:
+            return 0
+
+        # the opponent can not win with the next stone
+        low = -((SIZE - 2 - moves) // 2)
+        if alpha < low:
+            alpha = low
+            if alpha >= beta:
+                return alpha
+        # we can not win with the next stone
+        high = (SIZE - 1 - moves) // 2
+        if beta > high:
+            beta = high
+            if alpha >= beta:
+                return beta
+
+        key = own + mask
+        entry = self.table.get(key)
+        if entry is not None:
+            lower, upper = entry
+            if lower >= beta:
+                return lower
+            if upper <= alpha:
+                return upper
+            if lower > alpha:
+                alpha = lower
+            if upper < beta:
+                beta = upper
+
+        # moves that make the most new threats first, center first on ties
+        children = []
+        for i, col in enumerate(ORDER):
+            move = moves_left & COLUMN_MASKS[col]
+            if move:
+                threats = popcount(winning_cells(own | move, mask))
+                children.append((-threats, i, move))
+        children.sort()
+
+        for _, _, move in children:
+            score = -self.negamax(own ^ mask, mask | move, moves + 1, -beta, -alpha)
+            if score >= beta:
+                self.store(key, score, None)
+                return score
+            if score > alpha:
+                alpha = score
+        self.store(key, None, alpha)
+        return alpha
+
+    def store(self, key, lower, upper):
+        if len(self.table) >= self.max_entries:
+            self.table = {}
+        old_lower, old_upper = self.table.get(key, (-SIZE, SIZE))
+        if lower is None:
+            lower = old_lower
+        if upper is None:
+            upper = old_upper
+        self.table[key] = (lower, upper)
+
+    def solve(self, own, mask, moves):
+        """
+        RETURNS:
+        The exact score of the position, narrowed down with null-window
+        searches
+        """
+        if winning_cells(own, mask) & (mask + BOTTOM_MASK) & BOARD_MASK:
+            return (SIZE + 1 - moves) // 2
+        low = -((SIZE - moves) // 2)
+        high = (SIZE + 1 - moves) // 2
+        while low < high:
+            med = low + (high - low) // 2
+            # look closer to 0 first, most positions are near a draw
+            if med <= 0 and int(low / 2) < med:
+                med = int(low / 2)
+            elif med >= 0 and int(high / 2) > med:
+                med = int(high / 2)
+            r = self.negamax(own, mask, moves, med, med + 1)
+            if r <= med:
+                high = r
+            else:
+                low = r
+        return low
+
+    def best_move(self, position, piece, check_time=None):
+        """
+        Solve a Bitboard position exactly
+
+        INPUTS:
+        position - a Bitboard, not yet decided
+        piece - the player to move
+        check_time - called now and then during the search, may raise to
+                     stop it
+
+        RETURNS:
+        (column, score, plies): the best column, its score for piece (see
+        the top of this file) and the plies until the game is decided, None
+        for a draw
+        """
+        self.check_time = check_time
+        self.nodes = 0
+        own = position.masks[piece - 1]
+        mask = position.occupied()
+        moves = popcount(mask)
+        possible = (mask + BOTTOM_MASK) & BOARD_MASK
+        columns = [col for col in ORDER if possible & COLUMN_MASKS[col]]
+        win = winning_cells(own, mask) & possible
+        for col in columns:
+            if win & COLUMN_MASKS[col]:
+                score = (SIZE + 1 - moves) // 2
+                return col, score, score_to_plies(score, moves)
+
+        score = self.solve(own, mask, moves)
+        for col in columns:
+            move = possible & COLUMN_MASKS[col]
+            child = mask | move
+            if winning_cells(own ^ mask, child) & (child + BOTTOM_MASK) & BOARD_MASK:
+                # the opponent wins with its next stone
+                if -((SIZE - moves) // 2) == score:
+                    return col, score, score_to_plies(score, moves)
+            elif -self.negamax(own ^ mask, child, moves + 1, -score, -score + 1) >= score:
+                return col, score, score_to_plies(score, moves)
+        return columns[0], score, score_to_plies(score, moves)
+
+
+def random_position(empty, rng):
+    """
+    RETURNS:
+    An undecided position from random play with that many empty cells and
+    the player to move, or None if the random game ended too early or the
+    player to move can win at once
+    """
+    position = Bitboard()
+    piece = 1
+    while SIZE - position.num_moves() > empty:
+        columns = [col for col in position.valid_columns()
+                   if not position.is_winning_move(col, piece)]
+        if not columns:
+            return None
+        position.make_move(rng.choice(columns), piece)
+        piece = 3 - piece
+    if any(position.is_winning_move(col, piece) for col in position.valid_columns()):
+        # solved without a search, not worth timing
+        return None
+    return position, piece
+
+
+def benchmark(empties, count, seed=0):
+    """
+    Solve count random positions for every number of empty cells and print
+    the mean and worst solve time
+    """
+    rng = random.Random(seed)
+    print('{:>6}{:>10}{:>10}{:>12}'.format('empty', 'mean s', 'max s', 'mean nodes'))
+    for empty in empties:
+        times = []
+        nodes = []
+        while len(times) < count:
+            found = random_position(empty, rng)
+            if found is None:
+                continue
+            position, piece = found
+            solver = EndgameSolver()
+            start = time.time()
+            solver.best_move(position, piece)
+            times.append(time.time() - start)
+            nodes.append(solver.nodes)
+        print('{:>6}{:>10.3f}{:>10.3f}{:>12.0f}'.format(
+            empty, sum(times) / count, max(times), sum(nodes) / count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the endgame solver on random positions')
+    parser.add_argument('--empty', type=int, nargs='+', default=[8, 12, 16, 20], help='Empty cells (ints)')
+    parser.add_argument('--count', type=int, default=20, help='Positions per empty count (int)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (int)')
+    args = parser.parse_args()
+
+    benchmark(args.empty, args.count, args.seed)
@@ -0,0 +1,164 @@
+# system libs
+import argparse
+import json
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Bitboard import board_geometry
+from Evaluator import geometry_tables, load_weights
+from SelfPlay import open_shard, shard_paths
+
+
+# evaluation points per unit of the regression's log-odds
+SCALE = 100
+# feature columns: own windows missing 1, 2 and 3 pieces, the same for the
+# opponent, own pieces in the center column
+FEATURES = 7
+
+
+def sigmoid(z):
+    return 1 / (1 + np.exp(-z))
+
+
+def window_features(boards, pieces, window_index, connect):
+    """
+    The counts the evaluation weights multiply, for a stack of boards
+
+    INPUTS:
+    boards - an (N, rows, columns) array of boards in the encoding Game uses
+    pieces - an (N,) array, the player every board is seen from
+    window_index - the geometry's window_index from geometry_tables
+    connect - pieces in a row that win
+
+    RETURNS:
+    An (N, FEATURES) float array
+    """
+    n = len(boards)
+    pieces = np.asarray(pieces).reshape(n, 1, 1)
+    cells = boards.reshape(n, -1)[:, window_index]
+    own = np.count_nonzero(cells == pieces, axis=2)
+    other = np.count_nonzero(cells == 3 - pieces, axis=2)
+    features = np.zeros((n, FEATURES))
+    for i in range(3):
+        # windows with connect - 1 - i pieces of one player and none of the other
+        k = connect - 1 - i
+        if k > 0:
+            features[:, i] = np.count_nonzero((own == k) & (other == 0), axis=1)
+            features[:, 3 + i] = np.count_nonzero((other == k) & (own == 0), axis=1)
+    features[:, 6] = np.count_nonzero(boards[:, :, boards.shape[2] // 2] == pieces[:, :, 0], axis=1)
+    return features
+
+
+def training_batch(records, window_index, connect):
+    """
+    Features and labels of a batch of records, every position seen once
+    from each player
+
+    RETURNS:
+    (x, y): x with a leading bias column of ones, as HW1 builds it, and y
+    the outcome for the player seen from, 1 for a win, 0.5 for a draw and
+    0 for a loss
+    """
+    boards = np.concatenate([records['board'], records['board']])
+    pieces = np.concatenate([records['to_move'], 3 - records['to_move']])
+    results = np.concatenate([records['result'], records['result']])
+    x = window_features(boards, pieces, window_index, connect)
+    x = np.column_stack((np.ones(len(x)), x))
+    y = np.where(results == pieces, 1.0, np.where(results == 0, 0.5, 0.0)).reshape(-1, 1)
+    return x, y
+
+
+def weights_vector(weights):
+    """
+    RETURNS:
+    An evaluation weights dict as regression weights, bias first
+    """
+    w = [0] + list(weights['own']) + [-v for v in weights['other']] + [weights['center']]
+    return np.array(w, dtype=float).reshape(-1, 1) / SCALE
+
+
+def vector_weights(w):
+    """
+    RETURNS:
+    Regression weights as an evaluation weights dict; the evaluation works
+    in integers, and the bias has no place in it
+    """
+    points = [int(round(v)) for v in w.ravel() * SCALE]
+    return {'own': points[1:4], 'other': [-v for v in points[4:7]], 'center': points[7]}
+
+
+def logistic_regression(directory, epochs=5, batch_size=4096, learning_rate=0.05, start=None, seed=0):
+    """
+    HW1's logistic_regression, trained in mini-batches streamed from the
+    shards in directory instead of on one array in memory. Each step is the
+    same update, averaged over the batch:
+    w = w + learning_rate * x.T ((y - h) h (1 - h))
+
+    INPUTS:
+    directory - shards written by SelfPlay.py, all on one board size
+    epochs - passes over the data, each in a new random batch order
+    batch_size - records per step, each gives two rows
+    learning_rate - learning rate
+    start - evaluation weights to start from, None for the defaults
+    seed - seed of the batch order
+
+    RETURNS:
+    (w, accuracy): the trained weights, a column vector with the bias
+    first, and the share of decided games the last epoch predicted right
+    """
+    shards = []
+    size = None
+    for path in shard_paths(directory):
+        records, shard_size = open_shard(path)
+        if size is not None and shard_size != size:
+            raise ValueError('{} is from a {}x{} connect {} board'.format(path, *shard_size))
+        size = shard_size
+        shards.append(records)
+    if size is None:
+        raise ValueError('no shards in {}'.format(directory))
+    rows, columns, connect = size
+    window_index = geometry_tables(board_geometry(rows, columns, connect))[1]
+    batches = [(i, begin) for i, records in enumerate(shards) for begin in range(0, len(records), batch_size)]
+
+    rng = np.random.default_rng(seed)
+    w = weights_vector(load_weights() if start is None else start)
+    accuracy = None
+    for epoch in range(epochs):
+        right = 0
+        decided = 0
+        for k in rng.permutation(len(batches)):
+            i, begin = batches[k]
+            x, y = training_batch(shards[i][begin:begin + batch_size], window_index, connect)
+            h = sigmoid(np.dot(x, w))
+            # draws say nothing about which side the prediction should favor
+            known = y != 0.5
+            right += np.count_nonzero((np.round(h) == y) & known)
+            decided += np.count_nonzero(known)
+            neg_gradient = np.dot(x.transpose(), (y - h) * h * (1 - h)) / len(x)
+            w = w + learning_rate * neg_gradient
+        accuracy = right / decided if decided else None
+        print('Epoch', epoch + 1, ' Accuracy: ', accuracy)
+    return w, accuracy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the evaluation weights to self-play game outcomes')
+    parser.add_argument('directory', help='Shards made by SelfPlay.py')
+    parser.add_argument('out', help='Weights file to write, loaded with AIPlayer(weights_path=...)')
+    parser.add_argument('--epochs', type=int, default=5, help='Passes over the data (int)')
+    parser.add_argument('--batch-size', type=int, default=4096, help='Positions per step (int)')
+    parser.add_argument('--learning-rate', type=float, default=0.05, help='Learning rate (float)')
+    parser.add_argument('--start', default=None, help='Weights file to start from, default the built-in weights')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the batch order (int)')
+    args = parser.parse_args()
+
+    start = load_weights(args.start) if args.start is not None else None
+    w, accuracy = logistic_regression(args.directory, args.epochs, args.batch_size, args.learning_rate, start,
+                                      args.seed)
+    weights = vector_weights(w)
+    with open(args.out, 'w') as f:
+        json.dump(weights, f)
+        f.write('\n')
+    print(weights)
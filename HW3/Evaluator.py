@@ -0,0 +1,206 @@
+import functools
+import json
+
+import numpy as np
+
+from Bitboard import STANDARD
+
+
+def _build_cell_windows(windows, num_bits):
+    """
+    RETURNS:
+    For every bitboard cell the indexes of the windows that contain it
+    """
+    cell_windows = [[] for _ in range(num_bits)]
+    for i, window in enumerate(windows):
+        for bit in range(num_bits):
+            if window >> bit & 1:
+                cell_windows[bit].append(i)
+    return cell_windows
+
+
+def _build_window_index(windows, rows, columns):
+    """
+    RETURNS:
+    A (len(windows), connect) array with the flat index into a row-major
+    numpy board (row 0 on top) of every cell of every window
+    """
+    h1 = rows + 1
+    index = []
+    for window in windows:
+        bits = [bit for bit in range(window.bit_length()) if window >> bit & 1]
+        index.append([(rows - 1 - bit % h1) * columns + bit // h1 for bit in bits])
+    return np.array(index, dtype=np.intp)
+
+
+@functools.lru_cache(maxsize=None)
+def geometry_tables(geometry):
+    """
+    RETURNS:
+    (cell_windows, window_index) of a Bitboard Geometry, built once per
+    geometry
+    """
+    return (_build_cell_windows(geometry.windows, geometry.num_bits),
+            _build_window_index(geometry.windows, geometry.rows, geometry.columns))
+
+
+CELL_WINDOWS, WINDOW_INDEX = geometry_tables(STANDARD)
+
+# evaluation weights: own[i] scores a window holding connect - 1 - i own
+# pieces and nothing else, other[i] is taken off for the same window of the
+# opponent, center is given for every own piece in the center column
+DEFAULT_WEIGHTS = {'own': [50, 20, 5], 'other': [50, 20, 5], 'center': 30}
+
+
+def load_weights(path=None):
+    """
+    Read evaluation weights written by EvalTrainer.py
+
+    INPUTS:
+    path - a JSON weights file, None for DEFAULT_WEIGHTS
+
+    RETURNS:
+    A dict shaped like DEFAULT_WEIGHTS
+    """
+    if path is None:
+        return {'own': list(DEFAULT_WEIGHTS['own']), 'other': list(DEFAULT_WEIGHTS['other']),
+                'center': DEFAULT_WEIGHTS['center']}
+    with open(path) as f:
+        data = json.load(f)
+    try:
+        weights = {'own': [int(w) for w in data['own']], 'other': [int(w) for w in data['other']],
+                   'center': int(data['center'])}
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('{} is not a weights file'.format(path))
+    if len(weights['own']) != 3 or len(weights['other']) != 3:
+        raise ValueError('{} needs three own and three other weights'.format(path))
+    return weights
+
+
+class IncrementalEvaluator:
+    def __init__(self, player_number, window_scores, center_bonus=30, geometry=STANDARD):
+        """
+        Keeps the piece counts of every window and the evaluation score of a
+        Bitboard up to date while moves are made and unmade, so a leaf is
+        scored without looking at the board
+
+        INPUTS:
+        player_number - the player the score is for
+        window_scores - AIPlayer.window_scores, score of every
+                        (own, other) piece count pair
+        center_bonus - score for every own piece in the center column
+        geometry - the Bitboard Geometry of the positions
+        """
+        self.player_number = player_number
+        connect = geometry.connect
+        self.windows = geometry.windows
+        self.cell_windows = geometry_tables(geometry)[0]
+        # score[n1][n2] of a window holding n1 pieces of player 1, n2 of player 2
+        self.score_table = [[0] * (connect + 1) for _ in range(connect + 1)]
+        for (own, other), score in window_scores.items():
+            if player_number == 1:
+                self.score_table[own][other] = score
+            else:
+                self.score_table[other][own] = score
+        # bonus of a piece of player_number on every cell
+        h1 = geometry.h1
+        center = geometry.columns // 2
+        self.bonus = [center_bonus if bit // h1 == center else 0 for bit in range(geometry.num_bits)]
+        # largest change of the score one non-winning move on a cell can make
+        table = self.score_table
+        steps = [abs(table[n1 + 1][n2] - table[n1][n2])
+                 for n1 in range(connect - 1) for n2 in range(connect - n1)]
+        steps += [abs(table[n1][n2 + 1] - table[n1][n2])
+                  for n2 in range(connect - 1) for n1 in range(connect - n2)]
+        step = max(steps)
+        self.move_bound = [step * len(self.cell_windows[bit]) + center_bonus * (bit // h1 == center)
+                           for bit in range(geometry.num_bits)]
+        self.max_move_bound = max(self.move_bound)
+        # counts[piece - 1][window]
+        self.counts = [[0] * len(self.windows), [0] * len(self.windows)]
+        self.score = 0
+
+    def attach(self, position):
+        """
+        Count the pieces of position from scratch and follow its moves from
+        now on
+        """
+        self.counts = [[0] * len(self.windows), [0] * len(self.windows)]
+        self.score = 0
+        for piece in (1, 2):
+            mask = position.masks[piece - 1]
+            counts = self.counts[piece - 1]
+            for i, window in enumerate(self.windows):
+                counts[i] = bin(mask & window).count('1')
+            if piece == self.player_number:
+                for bit, bonus in enumerate(self.bonus):
+                    if mask >> bit & 1:
+                        self.score += bonus
+        table = self.score_table
+        for n1, n2 in zip(*self.counts):
+            self.score += table[n1][n2]
+        position.evaluator = self
+
+    def add(self, bit, piece):
+        table = self.score_table
+        counts1, counts2 = self.counts
+        cell_windows = self.cell_windows
+        score = self.score
+        if piece == 1:
+            for w in cell_windows[bit]:
+                n1 = counts1[w]
+                n2 = counts2[w]
+                score += table[n1 + 1][n2] - table[n1][n2]
+                counts1[w] = n1 + 1
+        else:
+            for w in cell_windows[bit]:
+                n1 = counts1[w]
+                n2 = counts2[w]
+                score += table[n1][n2 + 1] - table[n1][n2]
+                counts2[w] = n2 + 1
+        if piece == self.player_number:
+            score += self.bonus[bit]
+        self.score = score
+
+    def gain(self, bit, piece):
+        """
+        RETURNS:
+        The score after a piece of piece on bit, without adding it
+        """
+        table = self.score_table
+        counts1, counts2 = self.counts
+        score = self.score
+        if piece == 1:
+            for w in self.cell_windows[bit]:
+                n1 = counts1[w]
+                n2 = counts2[w]
+                score += table[n1 + 1][n2] - table[n1][n2]
+        else:
+            for w in self.cell_windows[bit]:
+                n1 = counts1[w]
+                n2 = counts2[w]
+                score += table[n1][n2 + 1] - table[n1][n2]
+        if piece == self.player_number:
+            score += self.bonus[bit]
+        return score
+
+    def remove(self, bit, piece):
+        table = self.score_table
+        counts1, counts2 = self.counts
+        cell_windows = self.cell_windows
+        score = self.score
+        if piece == 1:
+            for w in cell_windows[bit]:
+                n1 = counts1[w]
+                n2 = counts2[w]
+                score += table[n1 - 1][n2] - table[n1][n2]
+                counts1[w] = n1 - 1
+        else:
+            for w in cell_windows[bit]:
+                n1 = counts1[w]
+                n2 = counts2[w]
+                score += table[n1][n2 - 1] - table[n1][n2]
+                counts2[w] = n2 - 1
+        if piece == self.player_number:
+            score -= self.bonus[bit]
+        self.score = score
@@ -0,0 +1,467 @@
+# system libs
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing as mp
+import random
+import time
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Bitboard import ROWS, COLUMNS, CONNECT
+from Player import AIPlayer
+from Rules import drop_piece, search_method, won_at
+
+
+# protocol: one JSON object per line each way over TCP, a reply for every
+# request, in order
+#
+#   {"op": "new", "opponent": "human" | "random", "ai_first": false,
+#    "time": 1.0, "rows": 6, "columns": 7, "connect": 4}
+#       -> {"game": id, "ai_move": column or null, "winner": null}
+#   {"op": "move", "game": id, "column": c}
+#       -> {"game": id, "ai_move": column or null, "winner": null | 0 | 1 | 2,
+#           "seconds": server time of the move}
+#   {"op": "stats"} -> {"games": n, "moves": n, "p50": s, "p99": s, ...}
+#
+# "opponent" is what the client plays like: against "random" the AI uses
+# expectimax, otherwise alpha-beta, as in Game. winner 0 is a draw.
+# Failed requests get {"error": message}. {"error": "busy"} means the
+# server had no time for the AI move: the request did nothing and can be
+# sent again. A move sent while the AI is still answering the previous one
+# of the same game is refused the same way.
+
+
+# part of the move time kept back for the queue and the reply, as in Game
+MARGIN = 0.2
+# largest board and move time a client may ask for; a bigger board makes a
+# pool worker build its tables for a long time, holding a slot
+MAX_ROWS = 12
+MAX_COLUMNS = 12
+MAX_TIME = 60.0
+
+
+def percentile(values, p):
+    """
+    RETURNS:
+    The nearest-rank p-th percentile (0 to 100) of values, None if empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(np.ceil(p / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+_pool_players = {}
+
+
+def pool_move(task):
+    """
+    Pool task: one AI move. Each worker keeps one AIPlayer per player number
+    and board size, so its tables are reused across all games it serves
+
+    RETURNS:
+    The column
+    """
+    player_number, method, board, time_limit, size = task
+    key = (player_number,) + size
+    if key not in _pool_players:
+        rows, columns, connect = size
+        _pool_players[key] = AIPlayer(player_number, rows=rows, columns=columns, connect=connect)
+    return int(getattr(_pool_players[key], method)(board, time_limit))
+
+
+def warm_up():
+    """
+    Pool task that does nothing: a spawned worker has imported everything
+    once it has run it
+    """
+    return None
+
+
+def check_new(rows, columns, connect, time_limit):
+    """
+    RETURNS:
+    An error message if the board size or move time of a 'new' request is
+    not a number in range, otherwise None
+    """
+    for name, value, high in (('rows', rows, MAX_ROWS), ('columns', columns, MAX_COLUMNS)):
+        if type(value) is not int or not 2 <= value <= high:
+            return '{} must be an integer from 2 to {}'.format(name, high)
+    if type(connect) is not int or not 2 <= connect <= max(rows, columns):
+        return 'no {}-in-a-row on a {}x{} board'.format(connect, rows, columns)
+    if type(time_limit) not in (int, float) or not 0 < time_limit <= MAX_TIME:
+        return 'time must be a number of seconds above 0 and at most {}'.format(MAX_TIME)
+    return None
+
+
+class ServerGame:
+    def __init__(self, game_id, opponent, ai_first, time_limit, rows, columns, connect):
+        """
+        One match between a client and the AI, played with the same rules
+        as Game: drop_piece rejects a full column, won_at finds the winner
+        and a full board without one is a draw
+        """
+        self.game_id = game_id
+        self.opponent = opponent
+        self.time_limit = time_limit
+        self.size = (rows, columns, connect)
+        self.board = np.zeros([rows, columns]).astype(np.uint8)
+        self.ai_number = 1 if ai_first else 2
+        self.client_number = 3 - self.ai_number
+        self.winner = None
+        # set while the AI's reply to a client move is being searched
+        self.thinking = False
+
+    def undo(self, col):
+        """
+        Take back the top piece of col
+        """
+        row = int(np.argmax(self.board[:, col] != 0))
+        self.board[row, col] = 0
+        self.winner = None
+
+    def play(self, col, player_num):
+        """
+        Drop a piece and decide whether the game is over
+
+        RETURNS:
+        An error message for an invalid move, otherwise None
+        """
+        if self.winner is not None:
+            return 'game {} is over'.format(self.game_id)
+        if not isinstance(col, int) or not 0 <= col < self.board.shape[1]:
+            return 'no column {}'.format(col)
+        try:
+            row = drop_piece(self.board, col, player_num)
+        except Exception as e:
+            return str(e)
+        if won_at(self.board, row, col, player_num, self.size[2]):
+            self.winner = player_num
+        elif 0 not in self.board[0]:
+            self.winner = 0
+        return None
+
+
+class Busy(Exception):
+    pass
+
+
+class PoolError(Exception):
+    """
+    The search pool failed to play a move, for example because a process
+    died and broke it; the message goes to the client
+    """
+
+
+class GameServer:
+    def __init__(self, workers=None, max_waiting=None):
+        """
+        Serves many games at once: connections and game state live on the
+        asyncio loop, every AI move runs in a bounded process pool
+
+        There is one slot per pool process, so a search starts as soon as
+        it is sent and gets the rest of its game's move time. AI moves wait
+        for a slot until their deadline; a move that does not get one in
+        time, or finds max_waiting moves already waiting, is answered with
+        "busy" and undone
+
+        INPUTS:
+        workers - pool processes, default all cores
+        max_waiting - AI moves waiting for a slot, default four per worker
+        """
+        # spawned, not forked: a forked worker would keep a copy of every
+        # client socket open at that moment
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'))
+        workers = self.pool._max_workers
+        self.slots = asyncio.Semaphore(workers)
+        self.waiting = 0
+        self.max_waiting = max_waiting or 4 * workers
+        self.games = {}
+        self.ids = itertools.count(1)
+        # seconds of every AI move, from request to reply
+        self.latencies = []
+        self.busy = 0
+        self.timeouts = 0
+        self.connections = set()
+
+    async def close(self):
+        # let the open connections see their clients go before the loop ends
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=1.0)
+        self.pool.shutdown()
+
+    async def ai_move(self, game, received):
+        """
+        Play the AI's move in game, within the game's time from received.
+        An AI whose search overruns the deadline forfeits, as in Game
+
+        RETURNS:
+        The column played, or None if the AI forfeited; raises Busy if no
+        slot was free in time and PoolError if the pool failed
+        """
+        margin = min(1.0, MARGIN * game.time_limit)
+        deadline = received + game.time_limit
+        if self.waiting >= self.max_waiting:
+            raise Busy()
+        self.waiting += 1
+        try:
+            # backpressure: wait for a pool slot, but only while there is
+            # still time to search
+            await asyncio.wait_for(self.slots.acquire(), deadline - margin - time.time())
+        except asyncio.TimeoutError:
+            raise Busy()
+        finally:
+            self.waiting -= 1
+        task = (game.ai_number, search_method(game.opponent), game.board.copy(),
+                max(0.01, deadline - margin - time.time()), game.size)
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, pool_move, task)
+        except Exception as e:
+            self.slots.release()
+            raise PoolError(repr(e))
+        # the slot is busy until the process is done, even with a forfeit
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            col = await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - time.time()) + margin)
+        except asyncio.TimeoutError:
+            col = None
+        except Exception as e:
+            raise PoolError(repr(e))
+        if col is None:
+            self.timeouts += 1
+            game.winner = game.client_number
+            return None
+        game.play(col, game.ai_number)
+        self.latencies.append(time.time() - received)
+        return col
+
+    async def handle(self, request, received):
+        """
+        RETURNS:
+        The reply dict for one request
+        """
+        op = request.get('op')
+        if op == 'new':
+            rows = request.get('rows', ROWS)
+            columns = request.get('columns', COLUMNS)
+            connect = request.get('connect', CONNECT)
+            time_limit = request.get('time', 1.0)
+            error = check_new(rows, columns, connect, time_limit)
+            if error is not None:
+                return {'error': error}
+            game = ServerGame(next(self.ids), request.get('opponent', 'human'), request.get('ai_first', False),
+                              float(time_limit), rows, columns, connect)
+            ai_move = None
+            if game.ai_number == 1:
+                try:
+                    ai_move = await self.ai_move(game, received)
+                except Busy:
+                    self.busy += 1
+                    return {'error': 'busy'}
+                except PoolError as e:
+                    return {'error': str(e)}
+            # an AI that forfeits its first move ends the game at once
+            if game.winner is None:
+                self.games[game.game_id] = game
+            return {'game': game.game_id, 'ai_move': ai_move, 'winner': game.winner}
+        if op == 'move':
+            game = self.games.get(request.get('game'))
+            if game is None:
+                return {'error': 'no game {}'.format(request.get('game'))}
+            # a second move before the AI has answered the first would
+            # play out of turn
+            if game.thinking:
+                return {'error': 'game {} is waiting for the AI move'.format(game.game_id)}
+            error = game.play(request.get('column'), game.client_number)
+            if error is not None:
+                return {'error': error}
+            ai_move = None
+            if game.winner is None:
+                game.thinking = True
+                try:
+                    ai_move = await self.ai_move(game, received)
+                except Busy:
+                    self.busy += 1
+                    game.undo(request['column'])
+                    return {'error': 'busy'}
+                except PoolError as e:
+                    game.undo(request['column'])
+                    return {'error': str(e)}
+                finally:
+                    game.thinking = False
+            if game.winner is not None:
+                del self.games[game.game_id]
+            return {'game': game.game_id, 'ai_move': ai_move, 'winner': game.winner,
+                    'seconds': time.time() - received}
+        if op == 'stats':
+            return self.stats()
+        return {'error': 'unknown op {}'.format(op)}
+
+    def stats(self):
+        return {
+            'games': len(self.games),
+            'moves': len(self.latencies),
+            'busy': self.busy,
+            'timeouts': self.timeouts,
+            'p50': percentile(self.latencies, 50),
+            'p99': percentile(self.latencies, 99),
+        }
+
+    async def serve_client(self, reader, writer):
+        # one request at a time per connection: a client that does not read
+        # its replies stops being read from
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                received = time.time()
+                try:
+                    request = json.loads(line)
+                    reply = await self.handle(request, received)
+                except (ValueError, TypeError, AttributeError) as e:
+                    reply = {'error': repr(e)}
+                writer.write((json.dumps(reply) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def start(self, host, port):
+        """
+        Start every pool process, then listen
+
+        RETURNS:
+        The asyncio Server
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, warm_up) for _ in range(self.pool._max_workers)))
+        return await asyncio.start_server(self.serve_client, host, port)
+
+
+async def client_game(host, port, time_limit, rng):
+    """
+    Load generator client: a random player against the AI over one
+    connection, sending a busy request again after a short pause
+
+    RETURNS:
+    (latencies, busy): the client-side seconds of every move that got an
+    AI reply, and how many busy replies it got
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def request(message):
+        nonlocal busy
+        while True:
+            start = time.time()
+            writer.write((json.dumps(message) + '\n').encode())
+            await writer.drain()
+            reply = json.loads(await reader.readline())
+            if reply.get('error') != 'busy':
+                return reply, time.time() - start
+            busy += 1
+            await asyncio.sleep(rng.uniform(0, time_limit))
+
+    latencies = []
+    busy = 0
+    board = np.zeros([ROWS, COLUMNS]).astype(np.uint8)
+    ai_first = rng.random() < 0.5
+    reply, seconds = await request({'op': 'new', 'opponent': 'random', 'ai_first': ai_first, 'time': time_limit})
+    game_id = reply['game']
+    if reply.get('ai_move') is not None:
+        latencies.append(seconds)
+        drop_piece(board, reply['ai_move'], 1)
+    while reply.get('winner') is None and 'error' not in reply:
+        col = rng.choice([c for c in range(COLUMNS) if board[0, c] == 0])
+        drop_piece(board, col, 2 if ai_first else 1)
+        reply, seconds = await request({'op': 'move', 'game': game_id, 'column': col})
+        if reply.get('ai_move') is not None:
+            latencies.append(seconds)
+            drop_piece(board, reply['ai_move'], 1 if ai_first else 2)
+    writer.close()
+    await writer.wait_closed()
+    return latencies, busy
+
+
+async def load_test(host, port, games, concurrency, time_limit, seed=0):
+    """
+    Play games random clients against the server, concurrency of them at
+    a time
+
+    RETURNS:
+    A dict with the client-side p50 and p99 move latency and the
+    server's own stats
+    """
+    rng = random.Random(seed)
+    running = asyncio.Semaphore(concurrency)
+
+    async def one_game(game_seed):
+        async with running:
+            return await client_game(host, port, time_limit, random.Random(game_seed))
+
+    start = time.time()
+    results = await asyncio.gather(*(one_game(rng.random()) for _ in range(games)))
+    wall_seconds = time.time() - start
+    latencies = [seconds for game, busy in results for seconds in game]
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"op": "stats"}\n')
+    await writer.drain()
+    server = json.loads(await reader.readline())
+    writer.close()
+    await writer.wait_closed()
+    return {
+        'games': games,
+        'moves': len(latencies),
+        'busy': sum(busy for game, busy in results),
+        'moves_per_second': len(latencies) / max(wall_seconds, 1e-9),
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'server': server,
+    }
+
+
+async def main(args):
+    server = GameServer(args.workers, args.max_waiting)
+    listener = await server.start(args.host, args.port)
+    port = listener.sockets[0].getsockname()[1]
+    try:
+        if args.load is None:
+            print('serving on {}:{}'.format(args.host, port))
+            await listener.serve_forever()
+        else:
+            result = await load_test(args.host, port, args.load, args.concurrency, args.time, args.seed)
+            print('{} games, {} AI moves, {:.1f} moves/s, {} busy replies'.format(
+                result['games'], result['moves'], result['moves_per_second'], result['busy']))
+            print('client move latency p50 {:.3f}s  p99 {:.3f}s'.format(result['p50'], result['p99']))
+            print('server move latency p50 {:.3f}s  p99 {:.3f}s, {} forfeits'.format(
+                result['server']['p50'], result['server']['p99'], result['server']['timeouts']))
+    finally:
+        listener.close()
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve many Connect 4 games against the AI')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='0 picks a free port (int)')
+    parser.add_argument('--workers', type=int, default=None, help='Search processes, default all cores')
+    parser.add_argument('--max-waiting', type=int, default=None,
+                        help='AI moves waiting for a search process, default four per process')
+    parser.add_argument('--load', type=int, default=None,
+                        help='Instead of serving, play this many local random games against the server (int)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Load test games at once (int)')
+    parser.add_argument('--time', type=float, default=0.5, help='Seconds per AI move in the load test')
+    parser.add_argument('--seed', type=int, default=0, help='Load test random seed (int)')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,222 @@
+# system libs
+import argparse
+import math
+import multiprocessing as mp
+import time
+from multiprocessing import shared_memory, util
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Benchmark import SETTINGS, corpus_positions
+from Bitboard import Bitboard
+from Player import AIPlayer
+from TranspositionTable import SharedTranspositionTable
+
+
+class RotatedOrderer:
+    """
+    Wraps a move orderer and rotates the order of the root moves, so every
+    helper starts its search on a different move
+    """
+
+    def __init__(self, orderer, shift):
+        self.orderer = orderer
+        self.shift = shift
+
+    def new_search(self):
+        self.orderer.new_search()
+
+    def order(self, position, moves, ply, piece, first=None):
+        moves = self.orderer.order(position, moves, ply, piece, first)
+        if ply == 0 and moves:
+            shift = self.shift % len(moves)
+            moves = moves[shift:] + moves[:shift]
+        return moves
+
+    def record_cutoff(self, position, col, ply, piece, depth):
+        self.orderer.record_cutoff(position, col, ply, piece, depth)
+
+
+def attach_board(name, rows, columns):
+    """
+    RETURNS:
+    (shm, control, board): the shared block of a LazySMP, its control word
+    (the id of the running search) and the numpy board stored after it
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    control = shm.buf[:8].cast('Q')
+    board = np.ndarray((rows, columns), dtype=np.uint8, buffer=shm.buf, offset=8)
+    return shm, control, board
+
+
+def helper(index, config, table_name, board_name, commands):
+    """
+    Runs in a helper process: searches every position the main search
+    announces until the search id in the shared block changes. Helpers
+    differ from the main search and from each other in the first depth
+    (odd helpers skip depth 1) and in the root move order
+
+    INPUTS:
+    index - the helper number, 1 and up
+    config - (player_number, rows, columns, connect, weights_path)
+    table_name - the SharedTranspositionTable to use
+    board_name - the LazySMP shared block
+    commands - queue of (search id, time limit), None to quit
+    """
+    player_number, rows, columns, connect, weights_path = config
+    player = AIPlayer(player_number, endgame_empty=0, rows=rows, columns=columns, connect=connect,
+                      weights_path=weights_path)
+    player.transposition_table = SharedTranspositionTable(name=table_name)
+    player.move_orderer = RotatedOrderer(player.move_orderer, index)
+    shm, control, board = attach_board(board_name, rows, columns)
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        search_id, time_limit = command
+        # the board may already be the next search's
+        if control[0] != search_id:
+            continue
+        array = board.copy()
+        if control[0] != search_id:
+            continue
+        position = Bitboard.from_array(array, player.geometry)
+        player.should_stop = lambda: control[0] != search_id
+        player.start_search(position)
+        try:
+            player.iterative_deepening(
+                position,
+                lambda depth: player.search_root(position, player_number, depth),
+                time_limit, first_depth=1 + index % 2)
+        finally:
+            player.should_stop = None
+    del board
+    control.release()
+    shm.close()
+    player.transposition_table.close()
+
+
+def shut_down(processes, commands, table, shm, control):
+    for queue in commands:
+        queue.put(None)
+    for process in processes:
+        process.join(1)
+        if process.is_alive():
+            process.terminate()
+    table.close()
+    control.release()
+    shm.close()
+    shm.unlink()
+
+
+class LazySMP:
+    def __init__(self, player, workers):
+        """
+        Helper processes for the alpha-beta searches of player. While the
+        player searches a position, every helper searches it too, and all
+        of them share one SharedTranspositionTable: the main search finds
+        the helpers' results in the table and runs into cutoffs sooner. The
+        main search alone decides the move.
+
+        The board goes to the helpers through a shared block next to the
+        table, the queues only carry the search id and time limit.
+
+        INPUTS:
+        player - the AIPlayer whose searches are helped
+        workers - number of helper processes
+        """
+        rows, columns = player.geometry.rows, player.geometry.columns
+        self.table = SharedTranspositionTable(player.transposition_table.size_mb)
+        self.shm = shared_memory.SharedMemory(create=True, size=8 + rows * columns)
+        self.control = self.shm.buf[:8].cast('Q')
+        self.board = np.ndarray((rows, columns), dtype=np.uint8, buffer=self.shm.buf, offset=8)
+        self.search_id = 0
+        self.control[0] = self.search_id
+        config = (player.player_number, rows, columns, player.geometry.connect, player.weights_path)
+        self.commands = [mp.Queue() for _ in range(workers)]
+        self.processes = [mp.Process(target=helper, args=(i + 1, config, self.table.name, self.shm.name, queue),
+                                     daemon=True)
+                          for i, queue in enumerate(self.commands)]
+        for process in self.processes:
+            process.start()
+        # frees the shared memory even if close is never called, also when
+        # the player lives in a multiprocessing child, which skips atexit;
+        # it has to run before the queues close at priority 10
+        self.finalizer = util.Finalize(self, shut_down,
+                                       (self.processes, self.commands, self.table, self.shm, self.control),
+                                       exitpriority=20)
+
+    def start(self, position, time_limit):
+        """
+        Put the helpers on position, the player to move being the helped
+        player, for at most time_limit seconds
+        """
+        self.search_id += 1
+        self.board[:] = position.to_array()
+        # the new id goes up after the board, so a helper never copies a
+        # board older than its search id
+        self.control[0] = self.search_id
+        for queue in self.commands:
+            queue.put((self.search_id, time_limit))
+
+    def stop(self):
+        self.search_id += 1
+        self.control[0] = self.search_id
+
+    def close(self):
+        # the board view has to go before the block can be closed
+        self.board = None
+        self.finalizer()
+
+
+def time_to_depth(phase, depth, workers):
+    """
+    Search every position of a benchmark phase to depth with workers
+    helpers, the table cleared between positions
+
+    RETURNS:
+    Wall-clock seconds of all the searches
+    """
+    seconds = 0
+    players = {}
+    for position, piece in corpus_positions(phase):
+        if piece not in players:
+            players[piece] = AIPlayer(piece, endgame_empty=0, smp_workers=workers)
+        player = players[piece]
+        helpers = player.lazy_smp() if workers else None
+        player.transposition_table.clear()
+        start = time.perf_counter()
+        player.start_search(position)
+        if helpers is not None:
+            helpers.start(position, math.inf)
+        try:
+            player.iterative_deepening(
+                position, lambda d: player.search_root(position, piece, d), math.inf, max_depth=depth)
+        finally:
+            if helpers is not None:
+                helpers.stop()
+        seconds += time.perf_counter() - start
+    for player in players.values():
+        if player.smp is not None:
+            player.smp.close()
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lazy SMP speedup over the benchmark corpus')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 3, 7],
+                        help='Helper process counts to compare (ints), 0 is the single-core search')
+    parser.add_argument('--phases', nargs='+', default=['opening', 'midgame'], help='Benchmark phases')
+    args = parser.parse_args()
+
+    print('{} cores'.format(mp.cpu_count()))
+    for phase in args.phases:
+        depth = SETTINGS[phase][0]
+        base = None
+        for workers in args.workers:
+            seconds = time_to_depth(phase, depth, workers)
+            base = base or seconds
+            print('{:8} depth {:2} helpers {:2}: {:7.2f}s  speedup {:.2f}x'.format(
+                phase, depth, workers, seconds, base / seconds))
@@ -0,0 +1,268 @@
+# system libs
+import argparse
+import math
+import time
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Bitboard import STANDARD
+
+
+# (row, column) steps of the four line directions on a numpy board
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+
+def random_playouts(boards, to_move, connect, rng):
+    """
+    Play every board to the end with uniformly random moves, all boards at
+    once: every step is a handful of numpy operations over the whole stack,
+    and finished games drop out of it
+
+    INPUTS:
+    boards - an (N, rows, columns) array of undecided boards in the
+             encoding Game uses
+    to_move - an (N,) array, the player to move on every board
+    connect - pieces in a row that win
+    rng - a numpy Generator
+
+    RETURNS:
+    An (N,) int8 array with the winner of every game, 0 for a draw
+    """
+    n, rows, columns = boards.shape
+    pad = connect - 1
+    # padding so a line can be followed past the edge without bounds checks
+    padded = np.zeros((n, rows + 2 * pad, columns + 2 * pad), dtype=np.int8)
+    padded[:, pad:pad + rows, pad:pad + columns] = boards
+    heights = np.count_nonzero(boards, axis=1)
+    moves = heights.sum(axis=1)
+    piece = np.asarray(to_move, dtype=np.int8).copy()
+    ids = np.arange(n)
+    winner = np.zeros(n, dtype=np.int8)
+
+    while len(ids):
+        count = len(ids)
+        # a random column that is not full
+        keys = rng.random((count, columns))
+        keys[heights >= rows] = -1
+        col = keys.argmax(axis=1)
+        every = np.arange(count)
+        row = rows - 1 - heights[every, col]
+        padded[ids, row + pad, col + pad] = piece
+        heights[every, col] += 1
+        moves += 1
+
+        # the only lines that can be complete run through the new piece
+        won = np.zeros(count, dtype=bool)
+        for dr, dc in DIRECTIONS:
+            length = np.ones(count, dtype=np.int8)
+            for sign in (1, -1):
+                run = np.ones(count, dtype=bool)
+                for k in range(1, connect):
+                    run &= padded[ids, row + pad + sign * k * dr, col + pad + sign * k * dc] == piece
+                    length += run
+            won |= length >= connect
+        winner[ids[won]] = piece[won]
+
+        going = ~(won | (moves == rows * columns))
+        ids = ids[going]
+        piece = 3 - piece[going]
+        heights = heights[going]
+        moves = moves[going]
+    return winner
+
+
+class Node:
+    __slots__ = ('move', 'piece', 'parent', 'children', 'untried', 'visits', 'wins', 'result')
+
+    def __init__(self, move, piece, parent, position):
+        """
+        INPUTS:
+        move - the column that led here, None for the root
+        piece - the player that played move; wins count for this player
+        parent - the parent Node
+        position - the Bitboard after move
+        """
+        self.move = move
+        self.piece = piece
+        self.parent = parent
+        self.children = []
+        self.visits = 0
+        self.wins = 0.0
+        # winner of a decided position (0 for a draw), None while undecided
+        self.result = None
+        if move is not None and position.game_completed():
+            self.result = piece if position.last_move_won() else 0
+            self.untried = []
+        else:
+            self.untried = position.valid_columns()
+
+
+class MCTS:
+    def __init__(self, player_number, geometry=STANDARD, leaves=64, playouts_per_leaf=16, exploration=1.4,
+                 seed=None):
+        """
+        Monte Carlo tree search with UCT selection. Leaves are picked in
+        batches, with a virtual loss on every path so one batch spreads over
+        the tree, and all playouts of a batch run in one random_playouts
+        call. The tree is kept between moves
+
+        INPUTS:
+        player_number - the player the search is for
+        geometry - the Bitboard Geometry of the game
+        leaves - leaves selected per batch
+        playouts_per_leaf - random games played from every leaf
+        exploration - the UCT exploration constant
+        seed - seed of the playout random generator
+        """
+        self.player_number = player_number
+        self.geometry = geometry
+        self.leaves = leaves
+        self.playouts_per_leaf = playouts_per_leaf
+        self.exploration = exploration
+        self.rng = np.random.default_rng(seed)
+        self.root = None
+        self.root_position = None
+        # playouts of the last search, and how many of them the reused tree
+        # already had
+        self.playouts = 0
+        self.reused = 0
+
+    def set_root(self, position):
+        """
+        Make position the root, keeping the subtree of the old tree that
+        leads to it: after our move and the opponent's reply it is a
+        grandchild of the old root
+        """
+        old, old_position = self.root, self.root_position
+        self.root = None
+        if old is not None and position.num_moves() in (old_position.num_moves(), old_position.num_moves() + 2):
+            if old_position.hash == position.hash:
+                self.root = old
+            else:
+                for child in old.children:
+                    old_position.make_move(child.move, child.piece)
+                    for grandchild in child.children:
+                        old_position.make_move(grandchild.move, grandchild.piece)
+                        if old_position.hash == position.hash:
+                            self.root = grandchild
+                        old_position.unmake_move()
+                    old_position.unmake_move()
+        if self.root is None:
+            self.root = Node(None, 3 - self.player_number, None, position)
+        self.root.parent = None
+        self.root_position = position
+
+    def select(self):
+        """
+        Walk down by UCT from the root and expand one untried move, adding
+        a virtual visit to every node on the way
+
+        RETURNS:
+        (leaf, position): the leaf Node and a Bitboard of it
+        """
+        position = self.root_position.copy()
+        node = self.root
+        node.visits += 1
+        while node.result is None:
+            if node.untried:
+                col = node.untried.pop(self.rng.integers(len(node.untried)))
+                piece = 3 - node.piece
+                position.make_move(col, piece)
+                child = Node(col, piece, node, position)
+                node.children.append(child)
+                child.visits += 1
+                return child, position
+            log_visits = math.log(node.visits)
+            c = self.exploration
+            node = max(node.children,
+                       key=lambda child: child.wins / child.visits + c * math.sqrt(log_visits / child.visits))
+            position.make_move(node.move, node.piece)
+            node.visits += 1
+        return node, position
+
+    def run_batch(self):
+        """
+        Select a batch of leaves, play them out and back up the results
+
+        RETURNS:
+        The number of playouts added
+        """
+        k = self.playouts_per_leaf
+        leaves = []
+        boards = []
+        to_move = []
+        for _ in range(self.leaves):
+            leaf, position = self.select()
+            leaves.append(leaf)
+            if leaf.result is None:
+                boards.append(position.to_array())
+                to_move.append(3 - leaf.piece)
+        if boards:
+            winners = random_playouts(np.repeat(np.array(boards), k, axis=0), np.repeat(to_move, k),
+                                      self.geometry.connect, self.rng)
+            counts = np.zeros((len(boards), 3), dtype=np.int64)
+            np.add.at(counts, (np.repeat(np.arange(len(boards)), k), winners), 1)
+        i = 0
+        for leaf in leaves:
+            if leaf.result is None:
+                draws, ones, twos = (int(x) for x in counts[i])
+                i += 1
+            else:
+                draws, ones, twos = k * (leaf.result == 0), k * (leaf.result == 1), k * (leaf.result == 2)
+            node = leaf
+            while node is not None:
+                # the virtual visit becomes k real ones
+                node.visits += k - 1
+                node.wins += (ones if node.piece == 1 else twos) + 0.5 * draws
+                node = node.parent
+        return k * len(leaves)
+
+    def search(self, position, time_limit=None, iterations=None):
+        """
+        INPUTS:
+        position - the Bitboard to move in, player_number to move
+        time_limit - seconds to search
+        iterations - random playouts to run, used when time_limit is None
+
+        RETURNS:
+        The column whose subtree was visited most
+        """
+        self.set_root(position)
+        self.reused = self.root.visits
+        self.playouts = 0
+        deadline = time.time() + time_limit if time_limit is not None else None
+        # at least one batch, so the root has a child to choose
+        while True:
+            self.playouts += self.run_batch()
+            if self.root.result is not None or len(self.root.children) == 1 and not self.root.untried:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+            if deadline is None and self.playouts >= iterations:
+                break
+        return max(self.root.children, key=lambda child: child.visits).move
+
+
+def playout_speed(batch, rounds=5, seed=0):
+    """
+    RETURNS:
+    Random playouts per second from the empty board, batch at a time
+    """
+    rng = np.random.default_rng(seed)
+    boards = np.zeros((batch, STANDARD.rows, STANDARD.columns), dtype=np.int8)
+    to_move = np.ones(batch, dtype=np.int8)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        random_playouts(boards, to_move, STANDARD.connect, rng)
+    return batch * rounds / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure random playout throughput')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 64, 1024, 8192], help='Batch sizes (ints)')
+    args = parser.parse_args()
+
+    for batch in args.batch:
+        print('batch {:>6}: {:>10.0f} playouts/s'.format(batch, playout_speed(batch, max(1, 8192 // batch))))
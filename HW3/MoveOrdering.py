@@ -0,0 +1,166 @@
+from Bitboard import ROWS, COLUMNS
+
+
+# positions the branching factor report searches, as the columns played
+# from an empty board (player 1 moves first)
+STANDARD_POSITIONS = [
+    '',
+    '3',
+    '33',
+    '3342',
+    '332245',
+    '3322443',
+    '3232454562',
+    '33332222',
+    '3332211456',
+    '23334456610',
+]
+
+
+def center_order(columns):
+    """
+    RETURNS:
+    The columns sorted from the center out, e.g. 3 2 4 1 5 0 6 for 7 columns
+    """
+    return sorted(range(columns), key=lambda c: (abs(2 * c - (columns - 1)), c))
+
+
+class NaturalOrderer:
+    """
+    Searches moves from left to right, only the given first move goes ahead.
+    This is how the alpha-beta search ordered moves before MoveOrderer
+    """
+
+    def new_search(self):
+        pass
+
+    def order(self, position, moves, ply, piece, first=None):
+        if first in moves:
+            moves.remove(first)
+            moves.insert(0, first)
+        return moves
+
+    def record_cutoff(self, position, col, ply, piece, depth):
+        pass
+
+
+class MoveOrderer:
+    def __init__(self, columns=COLUMNS, rows=ROWS, num_killers=2):
+        """
+        Orders the moves of an alpha-beta node, best guess first:
+
+        1. the move given as first (transposition table or previous
+           iteration best move)
+        2. killer moves: moves that caused a cutoff at the same ply
+        3. moves by history score: how often and how deep playing this
+           cell caused a cutoff so far in the search
+        4. the static order, center columns before the edges
+
+        INPUTS:
+        columns, rows - the board size
+        num_killers - how many killer moves are kept per ply
+        """
+        self.num_killers = num_killers
+        self.static_rank = [0] * columns
+        for rank, col in enumerate(center_order(columns)):
+            self.static_rank[col] = rank
+        # killers[ply] lists the most recent cutoff columns first
+        self.killers = []
+        # history[piece - 1][bit] for the bitboard cell the move fills
+        self.history = [[0] * (columns * (rows + 1)) for _ in range(2)]
+
+    def new_search(self):
+        """
+        Killers belong to the position they were found in, so they are
+        dropped between moves; history is halved so old results fade out
+        """
+        self.killers = []
+        for table in self.history:
+            for i in range(len(table)):
+                table[i] >>= 1
+
+    def order(self, position, moves, ply, piece, first=None):
+        """
+        INPUTS:
+        position - the Bitboard the moves are played on
+        moves - the valid columns
+        ply - distance from the root of the search
+        piece - the player to move
+        first - a move to search before all others, or None
+
+        RETURNS:
+        The moves in the order they should be searched
+        """
+        killers = self.killers[ply] if ply < len(self.killers) else ()
+        history = self.history[piece - 1]
+        heights = position.heights
+        static_rank = self.static_rank
+
+        def key(col):
+            if col == first:
+                return 0, 0
+            if col in killers:
+                return 1, killers.index(col)
+            return 2, -history[heights[col]] * len(static_rank) + static_rank[col]
+        return sorted(moves, key=key)
+
+    def record_cutoff(self, position, col, ply, piece, depth):
+        """
+        Called when col caused a beta cutoff, after the move was unmade
+        """
+        while len(self.killers) <= ply:
+            self.killers.append([])
+        killers = self.killers[ply]
+        if col in killers:
+            killers.remove(col)
+        killers.insert(0, col)
+        del killers[self.num_killers:]
+        self.history[piece - 1][position.heights[col]] += depth * depth
+
+
+def effective_branching_factor(nodes, depth):
+    """
+    RETURNS:
+    b such that a uniform tree of the given depth with branching factor b
+    has as many nodes as the search visited
+    """
+    low, high = 1.0, float(COLUMNS)
+    for _ in range(50):
+        b = (low + high) / 2
+        if sum(b ** i for i in range(depth + 1)) < nodes:
+            low = b
+        else:
+            high = b
+    return low
+
+
+def branching_report(depth=6):
+    """
+    Search every STANDARD_POSITIONS position to a fixed depth with the
+    natural and with the full move ordering and print the nodes visited and
+    the effective branching factor of each
+    """
+    from Bitboard import Bitboard
+    from Player import AIPlayer
+
+    print('{:<14}{:>10}{:>8}{:>10}{:>8}'.format('moves', 'natural', 'ebf', 'ordered', 'ebf'))
+    totals = [0, 0]
+    for moves in STANDARD_POSITIONS:
+        row = []
+        for i, orderer in enumerate([NaturalOrderer(), MoveOrderer()]):
+            position = Bitboard.from_moves(moves)
+            piece = 1 + len(moves) % 2
+            player = AIPlayer(piece, move_orderer=orderer)
+            player.start_search(position)
+            player.negamax(position, piece, depth)
+            totals[i] += player.nodes
+            row += [player.nodes, effective_branching_factor(player.nodes, depth)]
+        print('{:<14}{:>10}{:>8.2f}{:>10}{:>8.2f}'.format(moves or '-', *row))
+    n = len(STANDARD_POSITIONS)
+    print('{:<14}{:>10}{:>8.2f}{:>10}{:>8.2f}'.format(
+        'total', totals[0], effective_branching_factor(totals[0] / n, depth),
+        totals[1], effective_branching_factor(totals[1] / n, depth)))
+
+
+if __name__ == '__main__':
+    branching_report()
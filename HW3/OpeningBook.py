@@ -0,0 +1,173 @@
+# system libs
+import argparse
+import mmap
+import multiprocessing as mp
+import os
+import struct
+import time
+
+# Local libs
+from Bitboard import Bitboard
+
+
+# file layout: HEADER, then one RECORD per position sorted by zobrist hash
+MAGIC = b'C4BK'
+HEADER = struct.Struct('<4sIQ')     # magic, version, number of records
+RECORD = struct.Struct('<QBi')      # hash, best column, score
+VERSION = 1
+# scores are the int32 negamax scores of the side to move; books written
+# before negamax stored a won or lost position as +-(2 ** 31 - 1), which
+# still reads as a proven result
+
+
+class OpeningBook:
+    def __init__(self, path):
+        """
+        Read-only view of a book file written by generate_book. The file is
+        memory-mapped, so opening it costs nothing and the pages are shared
+        by every process that has the same book open.
+
+        INPUTS:
+        path - the book file
+        """
+        self.path = path
+        self.mm = None
+        self.count = 0
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not an opening book'.format(self.path))
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    # an mmap can not be pickled, a copy sent to another process maps the
+    # file again
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.mm = None
+        self.count = 0
+        self.open()
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, key):
+        """
+        Binary search for a position
+
+        INPUTS:
+        key - the zobrist hash of the position
+
+        RETURNS:
+        (column, score) for the side to move, or None if the position is not
+        in the book
+        """
+        mm = self.mm
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            found = RECORD.unpack_from(mm, HEADER.size + mid * RECORD.size)
+            if found[0] < key:
+                low = mid + 1
+            elif found[0] > key:
+                high = mid
+            else:
+                return found[1], found[2]
+        return None
+
+
+def book_positions(plies):
+    """
+    RETURNS:
+    The move strings of every distinct position reachable in at most plies
+    moves that is not already decided, one per zobrist hash
+    """
+    positions = []
+    seen = set()
+    frontier = ['']
+    for ply in range(plies + 1):
+        next_frontier = []
+        for moves in frontier:
+            position = Bitboard.from_moves(moves)
+            if position.hash in seen or position.game_completed():
+                continue
+            seen.add(position.hash)
+            positions.append(moves)
+            if ply < plies:
+                next_frontier.extend(moves + str(col) for col in position.valid_columns())
+        frontier = next_frontier
+    return positions
+
+
+_book_players = {}
+
+
+def search_position(task):
+    """
+    Pool task: alpha-beta search of one book position, the AIPlayer of each
+    side is kept for the whole run so its transposition table is reused
+
+    RETURNS:
+    (hash, column, score) with the score as stored in the book
+    """
+    from Player import AIPlayer
+
+    moves, depth = task
+    position = Bitboard.from_moves(moves)
+    piece = 1 + len(moves) % 2
+    if piece not in _book_players:
+        _book_players[piece] = AIPlayer(piece)
+    player = _book_players[piece]
+    player.start_search(position)
+    col, score = player.negamax(position, piece, depth)
+    return position.hash, col, int(score)
+
+
+def generate_book(path, plies, depth, workers=None):
+    """
+    Search every position up to plies moves deep in parallel and write the
+    best moves to path
+
+    INPUTS:
+    path - the book file to write
+    plies - the deepest position in the book, in moves from the start
+    depth - alpha-beta search depth of every position
+    workers - number of processes, default all cores
+
+    RETURNS:
+    The number of positions written
+    """
+    positions = book_positions(plies)
+    with mp.Pool(workers) as pool:
+        records = pool.map(search_position, [(moves, depth) for moves in positions], chunksize=16)
+    records.sort()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        for record in records:
+            f.write(RECORD.pack(*record))
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an opening book')
+    parser.add_argument('path', help='Book file to write')
+    parser.add_argument('--plies', type=int, default=6, help='Deepest book position in moves (int)')
+    parser.add_argument('--depth', type=int, default=8, help='Search depth of every position (int)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, default all cores')
+    args = parser.parse_args()
+
+    start = time.time()
+    count = generate_book(args.path, args.plies, args.depth, args.workers)
+    print('{} positions in {:.1f}s'.format(count, time.time() - start))
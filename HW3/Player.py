@@ -1,8 +1,18 @@
 import numpy as np
 import random
 import math
+import time
 from datetime import datetime
 
+from Bitboard import Bitboard, ROWS, COLUMNS, CONNECT, STANDARD, board_geometry
+from TranspositionTable import TranspositionTable, EXACT, LOWER, UPPER
+from MoveOrdering import MoveOrderer, center_order
+from Evaluator import IncrementalEvaluator, geometry_tables, load_weights
+from OpeningBook import OpeningBook
+from EndgameSolver import EndgameSolver
+from SearchStats import SearchStats
+from MCTS import MCTS
+
 
 # credit to:
 # https://github.com/AchintyaAshok/Connect4-AI-Final-Project
@@ -10,11 +20,145 @@ from datetime import datetime
 # https://github.com/KeithGalli/Connect4-Python
 
 
+# expectimax scores a won game as WIN_SCORE and a lost one as -WIN_SCORE,
+# the same as a four piece window in sliding_window; Star1 and Star2 need
+# these finite bounds to prune
+WIN_SCORE = 10000000
+# negamax scores a win with the stone at ply p from the root as
+# WIN_SCORE - p, so a faster win scores higher and a slower loss less low;
+# a score at least MATE_BOUND from 0 is a proven result
+MATE_BOUND = WIN_SCORE - 1000
+# a negamax window bound beyond every score
+INFINITY = WIN_SCORE + 1
+# half width of the first aspiration window around the score of the
+# previous iteration, about two three piece windows
+ASPIRATION_WINDOW = 100
+# share of the move time still searched when pondering guessed the
+# opponent's move right
+PONDER_KEEP = 0.25
+# random playouts of an untimed get_mcts_move
+MCTS_PLAYOUTS = 20000
+# depth of an untimed get_expectimax_move
+EXPECTIMAX_DEPTH = 6
+# share of the move time the endgame solver may take, the rest is kept for
+# the search if the solver does not finish
+ENDGAME_SHARE = 0.5
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def score_to_table(score, ply):
+    """
+    RETURNS:
+    A negamax score at ply as stored in the transposition table, wins and
+    losses counted from the stored node instead of the root
+    """
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
 class AIPlayer:
-    def __init__(self, player_number):
+    def __init__(self, player_number, table_mb=16, move_orderer=None, book_path=None, endgame_empty=20,
+                 stats_sink=None, rows=ROWS, columns=COLUMNS, connect=CONNECT, engine='minimax', weights_path=None,
+                 smp_workers=0, tactics=True, solver_mb=16):
         self.player_number = player_number
+        # 'minimax' plays alpha-beta or expectimax, 'mcts' get_mcts_move
+        self.engine = engine
+        # board size and line length, with their precomputed tables
+        self.geometry = board_geometry(rows, columns, connect)
+        self.window_index = geometry_tables(self.geometry)[1]
         self.type = 'ai'
         self.player_string = 'Player {}:ai'.format(player_number)
+        # kept between get_alpha_beta_move calls on this player
+        self.transposition_table = TranspositionTable(table_mb)
+        # helper processes searching next to every timed alpha-beta search
+        # (Lazy SMP), started with the first one; they share a
+        # SharedTranspositionTable that then replaces transposition_table
+        self.smp_workers = smp_workers
+        self.smp = None
+        # decides which child negamax searches first
+        self.move_orderer = move_orderer if move_orderer is not None else MoveOrderer(columns, rows)
+        # negamax looks for one-move wins and threats before
+        # searching a node's moves (forced_moves)
+        self.tactics = tactics
+        # length of the position history at the root of the running search
+        self.root_ply = 0
+        # negamax or expectimax_help calls of the last search
+        self.nodes = 0
+        # exact (column, value) of the nodes of the running expectimax
+        # search, by (position hash, depth, maximizing)
+        self.expectimax_cache = {}
+        # position of every column in the center-out order
+        self.center_rank = [0] * columns
+        for rank, col in enumerate(center_order(columns)):
+            self.center_rank[col] = rank
+        # best moves of early positions, looked up before searching
+        if book_path is not None and self.geometry is not STANDARD:
+            raise ValueError('opening books are for the standard board only')
+        self.opening_book = OpeningBook(book_path) if book_path is not None else None
+        # positions with at most endgame_empty empty cells are solved
+        # exactly; the solver only knows the standard board, and its table
+        # takes at most solver_mb megabytes
+        self.endgame_empty = endgame_empty
+        self.solver = EndgameSolver(solver_mb) if self.geometry is STANDARD else None
+        # the get_mcts_move search, whose tree is kept between moves
+        self.mcts = MCTS(player_number, self.geometry, seed=np.random.randint(2 ** 31))
+        # where every move's SearchStats go as a JSON line, None for nowhere
+        self.stats_sink = stats_sink
+        self.last_stats = None
+        # where the last move came from ('book', 'endgame' or 'search'),
+        # and the depth and score of the last finished search
+        self.move_source = None
+        self.search_depth = None
+        self.search_score = None
+        # wall-clock deadline of the running timed search, None for fixed depth
+        self.deadline = None
+        # best move of the last finished iteration, searched first at the root
+        self.root_move = None
+        # while pondering or helping a Lazy SMP search: polled every 1024
+        # nodes, stops the search once it returns True
+        self.should_stop = None
+        # hash of the position pondering searched and when it started, and
+        # how often the opponent then played the guessed move
+        self.ponder_hash = None
+        self.ponder_start = None
+        self.ponder_hits = 0
+        # window and center weights of the evaluation, from weights_path if
+        # there is one
+        self.weights_path = weights_path
+        self.weights = load_weights(weights_path)
+        # sliding_window score for every (own, other) piece count pair
+        self.window_scores = {}
+        other_number = 3 - player_number
+        for own in range(connect + 1):
+            for other in range(connect + 1 - own):
+                window = [player_number] * own + [other_number] * other + [0] * (connect - own - other)
+                self.window_scores[(own, other)] = self.sliding_window(window, player_number)
+        self.center_mask = ((1 << rows) - 1) << (columns // 2 * (rows + 1))
+        # window_scores as an array indexed by [own, other] for evaluate_boards
+        self.window_score_table = np.zeros([connect + 1, connect + 1])
+        for (own, other), score in self.window_scores.items():
+            self.window_score_table[own, other] = score
+        # largest absolute score of a position nobody has won yet
+        self.eval_bound = len(self.geometry.windows) * max(
+            abs(score) for (own, other), score in self.window_scores.items()
+            if own < connect and other < connect) + abs(self.weights['center']) * rows
+        # keeps the evaluation of the searched position up to date
+        self.evaluator = IncrementalEvaluator(player_number, self.window_scores, self.weights['center'],
+                                              self.geometry)
 
     def find_valid_columns(self, board):
         valid_cols = []
@@ -24,7 +168,7 @@ class AIPlayer:
         return valid_cols
 
     def find_row_to_drop(self, board, col):
-        for r in range(5, -1, -1):
+        for r in range(board.shape[0] - 1, -1, -1):
             if board[r][col] == 0:
                 return r
 
@@ -32,67 +176,46 @@ class AIPlayer:
         board[row][col] = piece
 
     def check_win(self, board, piece):
-        # Check horizontal locations for win
-        for c in range(4):
-            for r in range(5):
-                if board[r][c] == piece and board[r][c + 1] == piece and board[r][c + 2] == piece and board[r][
-                    c + 3] == piece:
-                    return True
-
-        # Check vertical locations for win
-        for c in range(7):
-            for r in range(3):
-                if board[r][c] == piece and board[r + 1][c] == piece and board[r + 2][c] == piece and board[r + 3][
-                    c] == piece:
-                    return True
-
-        # Check positively sloped diaganols
-        for c in range(4):
-            for r in range(3):
-                if board[r][c] == piece and board[r + 1][c + 1] == piece and board[r + 2][c + 2] == piece and \
-                        board[r + 3][c + 3] == piece:
-                    return True
-
-        # Check negatively sloped diaganols
-        for c in range(4):
-            for r in range(3, 5):
-                if board[r][c] == piece and board[r - 1][c + 1] == piece and board[r - 2][c + 2] == piece and \
-                        board[r - 3][c + 3] == piece:
-                    return True
+        # every line of the board's geometry, from the precomputed index
+        # of its cells
+        cells = np.asarray(board).ravel()[self.window_index]
+        return bool(np.any(np.all(cells == piece, axis=1)))
 
     def game_completed(self, board):
-        valid_cols = []
-        for col in range(board.shape[1]):
-            if 0 in board[:, col]:
-                valid_cols.append(col)
-        return self.check_win(board, 1) or self.check_win(board, 2) or len(valid_cols) == 0
+        # the top row is only full once every column is
+        return self.check_win(board, 1) or self.check_win(board, 2) or 0 not in board[0]
 
     def sliding_window(self, window, piece):
         score = 0
         other_piece = 1
         if piece == 1:
             other_piece = 2
+        own_weights = self.weights['own']
+        other_weights = self.weights['other']
 
+        # a line of n needs n pieces to win; windows that miss one, two or
+        # three pieces score as they do for connect 4
+        n = len(window)
         count_piece = window.count(piece)
         count_other_piece = window.count(other_piece)
         count_zero = window.count(0)
-        if count_piece == 4 and count_zero == 0:
+        if count_piece == n:
             score += 10000000
-        elif count_piece == 3 and count_zero == 1:
-            score += 50
-        elif count_piece == 2 and count_zero == 2:
-            score += 20
-        elif count_piece == 1 and count_zero == 3:
-            score += 5
-
-        if count_other_piece == 4 and count_zero == 0:
+        elif count_piece == n - 1 and count_zero == 1:
+            score += own_weights[0]
+        elif count_piece == n - 2 and count_zero == 2 and count_piece:
+            score += own_weights[1]
+        elif count_piece == n - 3 and count_zero == 3 and count_piece:
+            score += own_weights[2]
+
+        if count_other_piece == n:
             score -= 10000000
-        elif count_other_piece == 3 and count_zero == 1:
-            score -= 50
-        elif count_other_piece == 2 and count_zero == 2:
-            score -= 20
-        elif count_other_piece == 1 and count_zero == 3:
-            score -= 5
+        elif count_other_piece == n - 1 and count_zero == 1:
+            score -= other_weights[0]
+        elif count_other_piece == n - 2 and count_zero == 2 and count_other_piece:
+            score -= other_weights[1]
+        elif count_other_piece == n - 3 and count_zero == 3 and count_other_piece:
+            score -= other_weights[2]
 
         return score
 
@@ -124,126 +247,667 @@ class AIPlayer:
                 return 0
 
         res = 0
+        rows, columns = board.shape
+        n = self.geometry.connect
         # vertical
-        for c in range(7):
+        for c in range(columns):
             col_array = [int(i) for i in list(board[:, c])]
-            for r in range(3):
-                window = col_array[r:r + 4]
+            for r in range(rows - n + 1):
+                window = col_array[r:r + n]
                 res += self.sliding_window(window, self.player_number)
 
         # horizontal
-        for r in range(6):
+        for r in range(rows):
             row_array = [int(i) for i in list(board[r, :])]
-            for c in range(4):
-                window = row_array[c:c + 4]
+            for c in range(columns - n + 1):
+                window = row_array[c:c + n]
                 res += self.sliding_window(window, self.player_number)
 
         # main_diagonal
-        for r in range(3):
-            for c in range(4):
-                window = [board[r + i][c + i] for i in range(4)]
+        for r in range(rows - n + 1):
+            for c in range(columns - n + 1):
+                window = [board[r + i][c + i] for i in range(n)]
                 res += self.sliding_window(window, self.player_number)
 
         # off_diagonal
-        for r in range(3):
-            for c in range(4):
-                window = [board[r + 3 - i][c + i] for i in range(4)]
+        for r in range(rows - n + 1):
+            for c in range(columns - n + 1):
+                window = [board[r + n - 1 - i][c + i] for i in range(n)]
                 res += self.sliding_window(window, self.player_number)
 
         # center columns
-        center_array = [int(i) for i in list(board[:, 3])]
+        center_array = [int(i) for i in list(board[:, columns // 2])]
         center_count = center_array.count(self.player_number)
-        res += center_count * 30
+        res += center_count * self.weights['center']
         return res
 
-    def alpha_beta_help(self, board, piece, depth, alpha, beta, maximizingPlayer):
+    def evaluate_boards(self, boards, batch_size=65536):
+        """
+        Vectorized evaluation_function over a stack of boards
+
+        Every window is scored by looking up its (own, other) piece counts
+        in window_score_table; a window full of one player's pieces is a
+        win, and a full board without one is a draw.
+
+        INPUTS:
+        boards - an (N, rows, columns) uint8 array of boards in the encoding
+                 Game uses
+        batch_size - boards scored per numpy pass, bounds the memory used
+
+        RETURNS:
+        A float array of the N utility values
+        """
+        boards = np.asarray(boards)
+        piece = self.player_number
+        other_piece = 3 - piece
+        scores = np.empty(len(boards))
+        for start in range(0, len(boards), batch_size):
+            batch = boards[start:start + batch_size]
+            cells = batch.reshape(len(batch), -1)[:, self.window_index]
+            own = np.count_nonzero(cells == piece, axis=2)
+            other = np.count_nonzero(cells == other_piece, axis=2)
+            res = self.window_score_table[own, other].sum(axis=1)
+            # center columns
+            center = np.count_nonzero(batch[:, :, self.geometry.columns // 2] == piece, axis=1)
+            res += center * self.weights['center']
+
+            res[np.all(batch[:, 0, :] != 0, axis=1)] = 0
+            res[np.any(other == self.geometry.connect, axis=1)] = -math.inf
+            res[np.any(own == self.geometry.connect, axis=1)] = math.inf
+            scores[start:start + len(batch)] = res
+        return scores
+
+    def evaluate_position(self, position):
+        """
+        Same score as evaluation_function, computed on a Bitboard
+
+        INPUTS:
+        position - a Bitboard
+
+        RETURNS:
+        The utility value for the current position
+        """
+        if position.game_completed():
+            return self.terminal_score(position)
+        if position.evaluator is not None:
+            return position.evaluator.score
+
+        own = position.masks[self.player_number - 1]
+        other = position.masks[2 - self.player_number]
+        window_scores = self.window_scores
+        popcount = self.geometry.popcount
+        res = 0
+        for window in self.geometry.windows:
+            own_part = own & window
+            other_part = other & window
+            # a window holding both colors scores nothing for either player
+            if not other_part:
+                if own_part:
+                    res += window_scores[(popcount[own_part], 0)]
+            elif not own_part:
+                res += window_scores[(0, popcount[other_part])]
+
+        # center columns
+        res += bin(own & self.center_mask).count('1') * self.weights['center']
+        return res
+
+    def terminal_score(self, position, win=math.inf):
+        winner = position.winner()
+        if winner == self.player_number:
+            return win
+        elif winner:
+            return -win
+        else:
+            return 0
+
+    def solve_endgame(self, position, piece, time_limit):
+        """
+        Solve the position exactly if few enough cells are empty
+
+        INPUTS:
+        position - the Bitboard to solve
+        piece - the player to move
+        time_limit - seconds of the whole move, the solver may take
+                     ENDGAME_SHARE of it; None for no limit
+
+        RETURNS:
+        (column, score) with the score for piece on the scale of negamax,
+        WIN_SCORE - p for a win with the stone at ply p and 0 for a draw,
+        or None if the position is not an endgame or time ran out
+        """
+        empty = position.rows * position.columns - position.num_moves()
+        if self.solver is None or empty > self.endgame_empty:
+            return None
+        if time_limit is not None:
+            self.deadline = time.time() + ENDGAME_SHARE * time_limit
+        try:
+            col, score, plies = self.solver.best_move(position, piece, self.check_time)
+            if score > 0:
+                return col, WIN_SCORE - plies
+            if score < 0:
+                return col, plies - WIN_SCORE
+            return col, 0
+        except SearchTimeout:
+            return None
+        finally:
+            self.deadline = None
+
+    def check_time(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise SearchTimeout()
+        if self.should_stop is not None and not self.nodes & 1023 and self.should_stop():
+            raise SearchTimeout()
+
+    def ponder(self, board, stop):
+        """
+        Search on the opponent's time: guess the opponent's reply from the
+        transposition table and search the position after it as our next
+        move, until stop returns True. The results stay in the table; if
+        the guess was right the next get_alpha_beta_move counts the time
+        pondered as already spent on its move
+
+        INPUTS:
+        board - the numpy board after our move, the opponent to move
+        stop - function returning True once the opponent has moved, polled
+               during the search
+
+        RETURNS:
+        The guessed opponent column, None if the game is over
+        """
+        piece = self.player_number
+        other = 3 - piece
+        position = Bitboard.from_array(board, self.geometry)
+        if position.game_completed():
+            return None
+        guess = self.transposition_table.best_move(position.hash)
+        if guess is None or not position.can_play(guess):
+            # no table entry, a shallow search for the opponent's best reply
+            self.start_search(position)
+            guess = self.negamax(position, other, 2)[0]
+        position.make_move(guess, other)
+        if position.game_completed():
+            return guess
+
+        self.ponder_hash = position.hash
+        self.ponder_start = time.time()
+        self.should_stop = stop
+        try:
+            self.start_search(position)
+            self.iterative_deepening(position, lambda depth: self.search_root(position, piece, depth), math.inf)
+        finally:
+            self.should_stop = None
+        return guess
+
+    def iterative_deepening(self, position, search, time_limit, first_depth=1, max_depth=None):
+        """
+        Run search at depth 1, 2, 3... until time_limit seconds have passed.
+        The first depth always finishes, however short the time, so there is
+        a searched move to return
+
+        INPUTS:
+        position - the Bitboard being searched
+        search - function taking a depth and returning (column, score)
+        time_limit - seconds the search may take
+        first_depth - the depth to start at
+        max_depth - the depth to stop after, None to go on until the board
+                    is full
+
+        RETURNS:
+        The column of the deepest fully searched iteration, None only if
+        should_stop ended the first one
+        """
+        deadline = time.time() + time_limit
+        self.deadline = None
+        self.root_move = None
+        best = None
+        root_moves = len(position.history)
+        empty = position.rows * position.columns - position.num_moves()
+        if max_depth is not None:
+            empty = min(empty, max_depth)
+        try:
+            for depth in range(min(first_depth, empty), empty + 1):
+                col, score = search(depth)
+                self.deadline = deadline
+                best = col
+                self.root_move = col
+                self.search_depth = depth
+                self.search_score = score
+                # a proven win or loss will not change at a deeper depth
+                if abs(score) >= MATE_BOUND:
+                    break
+        except SearchTimeout:
+            # the aborted search left its moves on the board
+            while len(position.history) > root_moves:
+                position.unmake_move()
+        finally:
+            self.deadline = None
+            self.root_move = None
+        return best
+
+    def lazy_smp(self):
+        """
+        RETURNS:
+        The LazySMP helpers of this player, started on the first call
+        """
+        if self.smp is None:
+            # LazySMP builds AIPlayers in its helpers, so it imports this module
+            from LazySMP import LazySMP
+            self.smp = LazySMP(self, self.smp_workers)
+            # the counters go on where the local table left them
+            self.smp.table.probes = self.transposition_table.probes
+            self.smp.table.hits = self.transposition_table.hits
+            self.transposition_table = self.smp.table
+        return self.smp
+
+    def start_search(self, position):
+        """
+        Get ready for a negamax search rooted at position
+        """
+        self.root_ply = len(position.history)
+        self.nodes = 0
+        self.evaluator.attach(position)
+        self.transposition_table.new_search()
+        self.move_orderer.new_search()
+
+    def forced_moves(self, position, piece, moves):
+        """
+        Tactical pre-pass of an alpha-beta node: immediate wins, forced
+        blocks and poisoned columns, found without searching a subtree. A
+        column is poisoned when the opponent wins on the cell above the one
+        piece would fill
+
+        INPUTS:
+        position - the Bitboard being searched, not yet won by anyone
+        piece - the player to move
+        moves - the valid columns
+
+        RETURNS:
+        (moves, result): result is 1 when piece wins at once, moves then
+        being the winning move; -1 when the opponent wins with its next
+        move whatever piece plays, with two threats to block or every
+        column poisoned; otherwise 0, and moves are the ones worth
+        searching: the block of a single threat, or else every column that
+        is not poisoned
+        """
+        other_piece = 3 - piece
+        threats = []
+        for col in moves:
+            if position.is_winning_move(col, piece):
+                return [col], 1
+            if position.is_winning_move(col, other_piece):
+                threats.append(col)
+        if threats:
+            return threats, -1 if len(threats) > 1 else 0
+        safe = [col for col in moves if not position.wins_on_top(col, other_piece)]
+        if not safe:
+            return moves, -1
+        return safe, 0
+
+    def negamax(self, position, piece, depth, alpha=-INFINITY, beta=INFINITY):
+        """
+        Alpha-beta search in negamax form, with principal variation search:
+        the first move is searched with the whole window, every later one
+        with a null window that only asks whether it beats the best so far,
+        and again with the whole window if it does
+
+        INPUTS:
+        position - the Bitboard being searched
+        piece - the player to move
+        depth - plies left to search
+        alpha, beta - the window, in scores for piece
+
+        RETURNS:
+        (column, score) with the score for piece: the evaluation at the
+        leaves, WIN_SCORE - p for a win with the stone at ply p from the
+        root of the search and p - WIN_SCORE for such a loss
+        """
+        self.check_time()
+        self.nodes += 1
+        ply = len(position.history) - self.root_ply
+        if position.game_completed():
+            winner = position.winner()
+            if not winner:
+                return None, 0
+            return None, WIN_SCORE - ply if winner == piece else ply - WIN_SCORE
+        if depth == 0:
+            score = self.evaluate_position(position)
+            return None, score if piece == self.player_number else -score
+
+        # mate distance: nothing beats winning with the next stone or is
+        # worse than losing to the opponent's next one
+        alpha = max(alpha, ply + 2 - WIN_SCORE)
+        beta = min(beta, WIN_SCORE - ply - 1)
+        if alpha >= beta:
+            return None, alpha
+
+        # transposition table: reuse a deep enough result, or at least try
+        # its best move first. Not at the root, where a bound from the table
+        # would leave no move searched inside the window to return
+        first = None
+        entry = self.transposition_table.probe(position.hash)
+        if entry is not None:
+            entry_depth, flag, score, move = entry
+            score = score_from_table(score, ply)
+            if entry_depth >= depth and ply > 0:
+                if flag == EXACT:
+                    return move, score
+                elif flag == LOWER:
+                    alpha = max(alpha, score)
+                elif flag == UPPER:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return move, score
+            first = move
+        valid_locations = position.valid_columns()
+        if self.tactics and depth > 1:
+            valid_locations, result = self.forced_moves(position, piece, valid_locations)
+            # proven without a search, a deeper one cannot change it
+            if result > 0:
+                return valid_locations[0], WIN_SCORE - ply - 1
+            elif result < 0:
+                return valid_locations[0], ply + 2 - WIN_SCORE
+        if ply == 0 and self.root_move is not None:
+            first = self.root_move
+        valid_locations = self.move_orderer.order(position, valid_locations, ply, piece, first)
+
+        alpha_orig = alpha
+        other_piece = 3 - piece
+        value = -INFINITY
+        column = valid_locations[0]
+        for i, col in enumerate(valid_locations):
+            position.make_move(col, piece)
+            if i == 0:
+                new_score = -self.negamax(position, other_piece, depth - 1, -beta, -alpha)[1]
+            else:
+                new_score = -self.negamax(position, other_piece, depth - 1, -alpha - 1, -alpha)[1]
+                if alpha < new_score < beta:
+                    new_score = -self.negamax(position, other_piece, depth - 1, -beta, -alpha)[1]
+            position.unmake_move()
+            if new_score > value:
+                value = new_score
+                column = col
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                self.move_orderer.record_cutoff(position, col, ply, piece, depth)
+                break
+
+        if value <= alpha_orig:
+            flag = UPPER
+        elif value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.transposition_table.store(position.hash, depth, flag, score_to_table(value, ply), column)
+        return column, value
+
+    def search_root(self, position, piece, depth):
+        """
+        One iterative deepening step: negamax in an aspiration window
+        around the score of the previous iteration. When the score falls
+        outside, the window is widened on that side and searched again, all
+        the way once the score is a win or loss
+
+        RETURNS:
+        (column, score) as negamax
+        """
+        guess = self.search_score
+        if self.root_move is None or guess is None or abs(guess) >= MATE_BOUND:
+            return self.negamax(position, piece, depth)
+        delta = ASPIRATION_WINDOW
+        alpha, beta = guess - delta, guess + delta
+        while True:
+            col, score = self.negamax(position, piece, depth, alpha, beta)
+            if score <= alpha:
+                alpha = score - delta if score > -MATE_BOUND else -INFINITY
+            elif score >= beta:
+                beta = score + delta if score < MATE_BOUND else INFINITY
+            else:
+                return col, score
+            delta *= 4
+
+    def expectimax_help(self, position, piece, depth, maximizingPlayer, alpha=-WIN_SCORE, beta=WIN_SCORE,
+                        probe=False):
+        """
+        Expectimax with Star1 and Star2 pruning. Every score lies in
+        [-WIN_SCORE, WIN_SCORE], so once some replies of a chance node are
+        known the bounds on the rest bound its average, and the search can
+        stop when that average can no longer reach the (alpha, beta) window.
+
+        INPUTS:
+        position - the Bitboard being searched
+        piece - the player to move
+        depth - plies left to search
+        maximizingPlayer - True at our move, False at a chance node where
+                           the opponent plays any valid column equally likely
+        alpha, beta - the window the caller needs the value in
+        probe - only search the first move of a max node, which gives a
+                lower bound on its value (Star2 probing)
+
+        RETURNS:
+        (column, value); value is exact inside (alpha, beta), an upper
+        bound at or below alpha and a lower bound at or above beta
+        """
+        self.check_time()
+        self.nodes += 1
         other_piece = 1
         if piece == 1:
             other_piece = 2
-        valid_locations = self.find_valid_columns(board)
-        is_terminal = self.game_completed(board)
+        valid_locations = position.valid_columns()
+        is_terminal = position.game_completed()
         if depth == 0 or is_terminal:
             if is_terminal:
-                if self.check_win(board, self.player_number):
-                    return None, math.inf
-                elif self.check_win(board, 3 - self.player_number):
-                    return None, -math.inf
-                else:
-                    return None, 0
+                return None, self.terminal_score(position, WIN_SCORE)
             else:
-                return None, self.evaluation_function(board)
+                return None, self.evaluate_position(position)
 
-        if maximizingPlayer:
-            value = -math.inf
+        if maximizingPlayer:  # maximizing
+            # nothing scores above a win, no need to look further
+            for col in valid_locations:
+                if position.is_winning_move(col, piece):
+                    return col, WIN_SCORE
+            if depth == 1 and position.evaluator is not None:
+                valid_locations.sort(key=self.center_rank.__getitem__)
+                return self.best_leaf(position, piece, valid_locations[:1] if probe else valid_locations)
+            key = (position.hash, depth, True)
+            if not probe and key in self.expectimax_cache:
+                column, low, high = self.expectimax_cache[key]
+                if low >= beta or low == high:
+                    return column, low
+                if high <= alpha:
+                    return column, high
+            valid_locations.sort(key=self.center_rank.__getitem__)
+            if len(position.history) == self.root_ply:
+                first = self.root_move
+            else:
+                # the best column of a shallower search of this position,
+                # found by the last iteration of iterative deepening
+                first = self.expectimax_cache.get((position.hash, depth - 1, True), (None,))[0]
+            if first in valid_locations:
+                valid_locations.remove(first)
+                valid_locations.insert(0, first)
+            if probe:
+                valid_locations = valid_locations[:1]
+            value = -WIN_SCORE
             column = valid_locations[0]
             for col in valid_locations:
-                row = self.find_row_to_drop(board, col)
-                b_copy = board.copy()
-                self.drop_piece(b_copy, row, col, piece)
-                new_score = self.alpha_beta_help(b_copy, other_piece, depth - 1, alpha, beta, False)[1]
+                position.make_move(col, piece)
+                new_score = self.expectimax_help(position, other_piece, depth - 1, False, max(alpha, value), beta)[1]
+                position.unmake_move()
                 if new_score > value:
                     value = new_score
                     column = col
-                alpha = max(alpha, value)
-                if alpha >= beta:
+                if value >= beta:
+                    if col != valid_locations[-1]:
+                        self.expectimax_cutoff(col == valid_locations[0])
                     break
+            if not probe:
+                self.store_expectimax(key, column, value, alpha, beta)
             return column, value
-        else:
-            value = math.inf
-            column = valid_locations[0]
-            for col in valid_locations:
-                row = self.find_row_to_drop(board, col)
-                b_copy = board.copy()
-                self.drop_piece(b_copy, row, col, piece)
-                new_score = self.alpha_beta_help(b_copy, other_piece, depth - 1, alpha, beta, True)[1]
-                if new_score < value:
-                    value = new_score
-                    column = col
-                beta = min(beta, value)
-                if alpha >= beta:
-                    break
+
+        # chance node
+        evaluator = position.evaluator
+        key = (position.hash, depth, False)
+        if depth == 1 and evaluator is not None:
+            if key in self.expectimax_cache:
+                return self.expectimax_cache[key][:2]
+            column, value = self.average_leaf(position, piece, valid_locations)
+            self.expectimax_cache[key] = column, value, value
             return column, value
+        if key in self.expectimax_cache:
+            column, low, high = self.expectimax_cache[key]
+            if low >= beta or low == high:
+                return column, low
+            if high <= alpha:
+                return column, high
+        n = len(valid_locations)
+        column = valid_locations[0]
 
-    def expectimax_help(self, board, piece, depth, maximizingPlayer):
-        other_piece = 1
-        if piece == 1:
-            other_piece = 2
-        valid_locations = self.find_valid_columns(board)
-        is_terminal = self.game_completed(board)
-        if depth == 0 or is_terminal:
-            if is_terminal:
-                if self.check_win(board, self.player_number):
-                    return None, math.inf
-                elif self.check_win(board, 3 - self.player_number):
-                    return None, -math.inf
-                else:
-                    return None, 0
+        # bounds on the value of every reply: a reply that wins for the
+        # opponent is a known loss, one that leaves us a winning move a known
+        # win. Otherwise a win or loss can only come from a move still inside
+        # the horizon, so near the leaves the heuristic bounds hold. Right
+        # above the leaves the score can only move by what the one or two
+        # moves left can change (move_bound), unless the board may fill up
+        bound = self.eval_bound
+        near_full = position.num_moves() >= position.rows * position.columns - 2
+        if depth == 3:
+            child_low, child_high = -WIN_SCORE, bound
+        elif depth < 3:
+            child_low, child_high = -bound, bound
+        else:
+            child_low, child_high = -WIN_SCORE, WIN_SCORE
+        replies = []
+        for col in valid_locations:
+            if position.is_winning_move(col, piece):
+                # searched first, they pull the average down the most
+                replies.insert(0, (col, -WIN_SCORE, -WIN_SCORE))
+            elif depth > 1 and position.opponent_wins_after(col, piece):
+                replies.append((col, WIN_SCORE, WIN_SCORE))
+            elif depth < 3 and evaluator is not None and not near_full:
+                change = evaluator.move_bound[position.heights[col]]
+                if depth == 2:
+                    change += evaluator.max_move_bound
+                replies.append((col, max(child_low, evaluator.score - change),
+                                min(child_high, evaluator.score + change)))
             else:
-                return None, self.evaluation_function(board)
+                replies.append((col, child_low, child_high))
+        # the lowest and highest sum of the replies after reply i
+        rest_low = [0] * (n + 1)
+        rest_high = [0] * (n + 1)
+        for i in range(n - 1, -1, -1):
+            rest_low[i] = rest_low[i + 1] + replies[i][1]
+            rest_high[i] = rest_high[i + 1] + replies[i][2]
 
-        if maximizingPlayer:  # maximizing
-            value = -math.inf
-            column = valid_locations[0]
-            for col in valid_locations:
-                row = self.find_row_to_drop(board, col)
-                b_copy = board.copy()
-                self.drop_piece(b_copy, row, col, piece)
-                new_score = self.expectimax_help(b_copy, other_piece, depth - 1, False)[1]
-                if new_score > value:
-                    value = new_score
-                    column = col
+        # Star2: one move of ours after every reply gives a lower bound
+        # on each reply, together they may already reach beta
+        if beta < rest_high[0] / n:
+            total = 0
+            for i, (col, low, high) in enumerate(replies):
+                if low < high and depth > 1:
+                    child_beta = n * beta - total - rest_low[i + 1]
+                    position.make_move(col, piece)
+                    low = self.expectimax_help(position, other_piece, depth - 1, True, low, min(high, child_beta),
+                                               probe=True)[1]
+                    position.unmake_move()
+                total += low
+                if total + rest_low[i + 1] >= n * beta:
+                    # the whole Star1 pass is saved
+                    self.expectimax_cutoff(i == 0)
+                    return column, self.store_expectimax(key, column, (total + rest_low[i + 1]) / n, alpha, beta)
 
-        else:  # chance node
-            value = 0
-            column = valid_locations[0]
-            for col in valid_locations:
-                row = self.find_row_to_drop(board, col)
-                b_copy = board.copy()
-                self.drop_piece(b_copy, row, col, piece)
-                value += self.expectimax_help(b_copy, other_piece, depth - 1, True)[1] / 7
+        # Star1: every reply is searched with the window that decides
+        # whether the average can still end inside (alpha, beta)
+        total = 0
+        for i, (col, low, high) in enumerate(replies):
+            if low == high:
+                total += low
+            else:
+                child_alpha = n * alpha - total - rest_high[i + 1]
+                child_beta = n * beta - total - rest_low[i + 1]
+                position.make_move(col, piece)
+                total += self.expectimax_help(position, other_piece, depth - 1, True, max(low, child_alpha),
+                                              min(high, child_beta))[1]
+                position.unmake_move()
+            if total + rest_high[i + 1] <= n * alpha:
+                if i < n - 1:
+                    self.expectimax_cutoff(i == 0)
+                return column, self.store_expectimax(key, column, (total + rest_high[i + 1]) / n, alpha, beta)
+            if total + rest_low[i + 1] >= n * beta:
+                if i < n - 1:
+                    self.expectimax_cutoff(i == 0)
+                return column, self.store_expectimax(key, column, (total + rest_low[i + 1]) / n, alpha, beta)
+        return column, self.store_expectimax(key, column, total / n, alpha, beta)
+
+    def expectimax_cutoff(self, first):
+        """
+        Called where expectimax_help stops before it searched every move or
+        reply, first if the move or reply searched first caused it. Nothing
+        to do in the search itself; SearchStats counts the calls
+        """
+
+    def store_expectimax(self, key, column, value, alpha, beta):
+        """
+        Cache the result of an expectimax_help node searched with the window
+        (alpha, beta) as the bounds it proves: (column, low, high)
+
+        RETURNS:
+        value
+        """
+        if value >= beta:
+            self.expectimax_cache[key] = column, value, WIN_SCORE
+        elif value <= alpha:
+            self.expectimax_cache[key] = column, -WIN_SCORE, value
+        else:
+            self.expectimax_cache[key] = column, value, value
+        return value
+
+    def best_leaf(self, position, piece, columns):
+        """
+        The max node of expectimax_help one ply above the leaves, none of
+        whose columns wins. Every leaf is scored from the evaluator without
+        making the move, which is cheaper than a call per leaf and than any
+        bound on the leaves
+
+        RETURNS:
+        (column, value) of the best of columns
+        """
+        self.nodes += len(columns)
+        if position.num_moves() == position.rows * position.columns - 1:
+            # the board fills up, a draw
+            return columns[0], 0
+        evaluator = position.evaluator
+        heights = position.heights
+        column = columns[0]
+        value = -WIN_SCORE
+        for col in columns:
+            score = evaluator.gain(heights[col], piece)
+            if score > value:
+                value = score
+                column = col
         return column, value
 
-    def get_alpha_beta_move(self, board):
+    def average_leaf(self, position, piece, columns):
+        """
+        The chance node of expectimax_help one ply above the leaves, scored
+        like best_leaf
+
+        RETURNS:
+        (column, value) with the first of columns and the average of their
+        leaves
+        """
+        self.nodes += len(columns)
+        full = position.num_moves() == position.rows * position.columns - 1
+        evaluator = position.evaluator
+        total = 0
+        for col in columns:
+            if position.is_winning_move(col, piece):
+                total -= WIN_SCORE
+            elif not full:
+                # a draw scores 0
+                total += evaluator.gain(position.heights[col], piece)
+        return columns[0], total / len(columns)
+
+    def get_alpha_beta_move(self, board, time_limit=None, stats=False):
         """
         Given the current state of the board, return the next move based on
         the alpha-beta pruning algorithm
@@ -259,18 +923,60 @@ class AIPlayer:
                 - spaces that are unoccupied are marked as 0
                 - spaces that are occupied by player 1 have a 1 in them
                 - spaces that are occupied by player 2 have a 2 in them
+        time_limit - seconds the search may take; searches deeper until the
+                     time is up. None searches to the fixed depth of 4
+        stats - also return the SearchStats of the search
 
         RETURNS:
-        The 0 based index of the column that represents the next move
+        The 0 based index of the column that represents the next move, and
+        the SearchStats if stats is set
         """
+        if not stats and self.stats_sink is None:
+            return self.choose_alpha_beta_move(board, time_limit)
+        return self.run_with_stats('alpha_beta', self.choose_alpha_beta_move, board, time_limit, stats)
+
+    def choose_alpha_beta_move(self, board, time_limit):
         # before = datetime.now()
         piece = self.player_number
-        col, minimax_score = self.alpha_beta_help(board, piece, 4, -math.inf, math.inf, True)
+        position = Bitboard.from_array(board, self.geometry)
+        if self.opening_book is not None:
+            found = self.opening_book.lookup(position.hash)
+            if found is not None and position.can_play(found[0]):
+                self.move_source = 'book'
+                return found[0]
+        if position.hash == self.ponder_hash:
+            self.ponder_hits += 1
+            if time_limit is not None:
+                # the opponent's thinking time already went into this search
+                time_limit = max(PONDER_KEEP * time_limit, time_limit - (time.time() - self.ponder_start))
+        self.ponder_hash = None
+        start = time.time()
+        solved = self.solve_endgame(position, piece, time_limit)
+        if solved is not None:
+            self.move_source = 'endgame'
+            self.search_score = solved[1]
+            return solved[0]
+        self.move_source = 'search'
+        if time_limit is not None:
+            time_limit -= time.time() - start
+        helpers = self.lazy_smp() if time_limit is not None and self.smp_workers else None
+        self.start_search(position)
+        if time_limit is not None:
+            if helpers is not None:
+                helpers.start(position, time_limit)
+            try:
+                return self.iterative_deepening(
+                    position, lambda depth: self.search_root(position, piece, depth), time_limit)
+            finally:
+                if helpers is not None:
+                    helpers.stop()
+        col, minimax_score = self.negamax(position, piece, 4)
+        self.search_depth, self.search_score = 4, minimax_score
         # after = datetime.now()
         # print("alpha-beta time: {0}".format(after - before))
         return col
 
-    def get_expectimax_move(self, board):
+    def get_expectimax_move(self, board, time_limit=None, stats=False):
         """
         Given the current state of the board, return the next move based on
         the expectimax algorithm.
@@ -287,17 +993,103 @@ class AIPlayer:
                 - spaces that are unoccupied are marked as 0
                 - spaces that are occupied by player 1 have a 1 in them
                 - spaces that are occupied by player 2 have a 2 in them
+        time_limit - seconds the search may take; searches deeper until the
+                     time is up. None searches to EXPECTIMAX_DEPTH
+        stats - also return the SearchStats of the search
 
         RETURNS:
-        The 0 based index of the column that represents the next move
+        The 0 based index of the column that represents the next move, and
+        the SearchStats if stats is set
         """
+        if not stats and self.stats_sink is None:
+            return self.choose_expectimax_move(board, time_limit)
+        return self.run_with_stats('expectimax', self.choose_expectimax_move, board, time_limit, stats)
+
+    def choose_expectimax_move(self, board, time_limit):
         # before = datetime.now()
         piece = self.player_number
-        col, score = self.expectimax_help(board, piece, 4, True)
+        position = Bitboard.from_array(board, self.geometry)
+        start = time.time()
+        solved = self.solve_endgame(position, piece, time_limit)
+        # a proven win is won against any opponent; otherwise the best
+        # minimax move is not the best one against random play
+        if solved is not None and solved[1] > 0:
+            self.move_source = 'endgame'
+            self.search_score = solved[1]
+            return solved[0]
+        self.move_source = 'search'
+        if time_limit is not None:
+            time_limit -= time.time() - start
+        self.root_ply = len(position.history)
+        self.nodes = 0
+        self.expectimax_cache.clear()
+        self.evaluator.attach(position)
+        if time_limit is not None:
+            return self.iterative_deepening(
+                position, lambda depth: self.expectimax_help(position, piece, depth, True), time_limit)
+        col, score = self.expectimax_help(position, piece, EXPECTIMAX_DEPTH, True)
+        self.search_depth, self.search_score = EXPECTIMAX_DEPTH, score
         # after = datetime.now()
         # print("alpha-beta time: {0}".format(after - before))
         return col
 
+    def get_mcts_move(self, board, time_limit=None, iterations=None):
+        """
+        Given the current state of the board, return the next move based on
+        Monte Carlo tree search. It needs no evaluation function, so it
+        holds up on big boards where minimax gets too shallow
+
+        INPUTS:
+        board - a numpy array containing the state of the board, encoded as
+                for get_alpha_beta_move
+        time_limit - seconds the search may take
+        iterations - random playouts to run when there is no time_limit;
+                     None runs MCTS_PLAYOUTS
+
+        RETURNS:
+        The 0 based index of the column that represents the next move
+        """
+        piece = self.player_number
+        position = Bitboard.from_array(board, self.geometry)
+        # random playouts take a while to see a win in one
+        self.move_source = 'search'
+        for col in position.valid_columns():
+            if position.is_winning_move(col, piece):
+                return col
+        if iterations is None:
+            iterations = MCTS_PLAYOUTS
+        col = self.mcts.search(position, time_limit, iterations)
+        # share of the playouts won, counted for the side to move
+        root = self.mcts.root
+        self.search_depth = None
+        self.search_score = 1 - root.wins / root.visits if root.visits else None
+        return col
+
+    def run_with_stats(self, search, choose, board, time_limit, return_stats):
+        """
+        Run choose(board, time_limit) with SearchStats installed, keep them
+        in last_stats and write them to stats_sink
+
+        RETURNS:
+        The column, and the SearchStats if return_stats is set
+        """
+        stats = SearchStats(search, self.player_number)
+        self.move_source = None
+        self.search_depth = None
+        self.search_score = None
+        stats.install(self)
+        try:
+            col = choose(board, time_limit)
+        finally:
+            stats.uninstall(self)
+        stats.finish(self, col)
+        self.last_stats = stats
+        if self.stats_sink is not None:
+            stats.write(self.stats_sink)
+        if return_stats:
+            return col, stats
+        return col
+
 
 class RandomPlayer:
     def __init__(self, player_number):
@@ -0,0 +1,58 @@
+# Local libs
+from Bitboard import CONNECT
+
+
+def drop_piece(board, move, player_num):
+    """
+    Drop a piece of player_num into column move of board, in place
+
+    RETURNS:
+    The row the piece landed in
+    """
+    if 0 in board[:,move]:
+        # the lowest empty cell, row 0 is on top; a board of one row has
+        # only that row
+        update_row = board.shape[0] - 1
+        while board[update_row, move] > 0:
+            update_row -= 1
+        board[update_row, move] = player_num
+        return update_row
+    else:
+        err = 'Invalid move by player {}. Column {}'.format(player_num, move)
+        raise Exception(err)
+
+
+def won_at(board, row, col, player_num, connect=CONNECT):
+    """
+    Check only the four lines through (row, col), the cell of the piece
+    just played
+
+    RETURNS:
+    True if the piece of player_num at (row, col) is part of connect in a
+    row
+    """
+    rows, columns = board.shape
+    for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        count = 1
+        for sign in (1, -1):
+            r, c = row + sign * dr, col + sign * dc
+            while 0 <= r < rows and 0 <= c < columns and board[r, c] == player_num:
+                count += 1
+                r, c = r + sign * dr, c + sign * dc
+        if count >= connect:
+            return True
+    return False
+
+
+def search_method(opponent_type, engine='minimax'):
+    """
+    RETURNS:
+    The AIPlayer method that plays against an opponent of that type:
+    MCTS for the 'mcts' engine, otherwise expectimax against a random
+    player and alpha-beta against anyone else
+    """
+    if engine == 'mcts':
+        return 'get_mcts_move'
+    if opponent_type == 'random':
+        return 'get_expectimax_move'
+    return 'get_alpha_beta_move'
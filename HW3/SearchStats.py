@@ -0,0 +1,251 @@
+import json
+import time
+
+
+class CountingDict(dict):
+    """
+    A dict that counts membership tests and how many of them found the key,
+    used for the expectimax cache while statistics are collected
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.probes = 0
+        self.hits = 0
+
+    def __contains__(self, key):
+        self.probes += 1
+        found = super().__contains__(key)
+        if found:
+            self.hits += 1
+        return found
+
+
+class StatsOrderer:
+    """
+    Wraps a move orderer: times the ordering and counts the cutoffs, and
+    which of them came from the first move searched
+    """
+
+    def __init__(self, orderer, stats):
+        self.orderer = orderer
+        self.stats = stats
+        # the move searched first at every ply, from the last order call
+        self.first = {}
+
+    def new_search(self):
+        self.orderer.new_search()
+
+    def order(self, position, moves, ply, piece, first=None):
+        start = time.perf_counter()
+        moves = self.orderer.order(position, moves, ply, piece, first)
+        self.stats.movegen_seconds += time.perf_counter() - start
+        self.first[ply] = moves[0]
+        return moves
+
+    def record_cutoff(self, position, col, ply, piece, depth):
+        self.stats.cutoffs += 1
+        if self.first.get(ply) == col:
+            self.stats.first_move_cutoffs += 1
+        self.orderer.record_cutoff(position, col, ply, piece, depth)
+
+
+class SearchStats:
+    def __init__(self, search, player_number):
+        """
+        Statistics of one get_alpha_beta_move or get_expectimax_move call.
+
+        Nothing in the search checks whether statistics are on. install
+        puts counting and timing wrappers on the player's instance, which
+        shadow its methods for the one call, and uninstall takes them off
+        again. With statistics off the search runs the plain methods.
+
+        INPUTS:
+        search - 'alpha_beta' or 'expectimax'
+        player_number - the player searching
+        """
+        self.search = search
+        self.player_number = player_number
+        # 'book', 'endgame' or 'search', where the move came from
+        self.source = None
+        self.move = None
+        self.score = None
+        self.depth = None
+        self.nodes_by_ply = []
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.table_probes = 0
+        self.table_hits = 0
+        self.eval_calls = 0
+        self.eval_seconds = 0.0
+        self.movegen_seconds = 0.0
+        self.total_seconds = 0.0
+        self.solver_nodes = 0
+        self.pv = []
+        self.root = None
+        self.start = None
+        self.table_start = (0, 0)
+
+    def install(self, player):
+        stats = self
+        self.start = time.perf_counter()
+        self.table_start = (player.transposition_table.probes, player.transposition_table.hits)
+
+        def count_node(search):
+            def counted(position, *args, **kwargs):
+                if stats.root is None:
+                    stats.root = position
+                    time_valid_columns(position)
+                ply = len(position.history) - player.root_ply
+                while len(stats.nodes_by_ply) <= ply:
+                    stats.nodes_by_ply.append(0)
+                stats.nodes_by_ply[ply] += 1
+                return search(position, *args, **kwargs)
+            return counted
+
+        def time_valid_columns(position):
+            valid_columns = position.valid_columns
+
+            def timed():
+                start = time.perf_counter()
+                columns = valid_columns()
+                stats.movegen_seconds += time.perf_counter() - start
+                return columns
+            position.valid_columns = timed
+
+        evaluate_position = player.evaluate_position
+
+        def timed_evaluate(position):
+            start = time.perf_counter()
+            score = evaluate_position(position)
+            stats.eval_seconds += time.perf_counter() - start
+            stats.eval_calls += 1
+            return score
+
+        def count_leaves(score_leaves):
+            # the leaves right below a node are scored in place, each counts
+            # as a node one ply down and as an evaluation
+            def counted(position, piece, columns):
+                ply = len(position.history) - player.root_ply + 1
+                while len(stats.nodes_by_ply) <= ply:
+                    stats.nodes_by_ply.append(0)
+                stats.nodes_by_ply[ply] += len(columns)
+                start = time.perf_counter()
+                result = score_leaves(position, piece, columns)
+                stats.eval_seconds += time.perf_counter() - start
+                stats.eval_calls += len(columns)
+                return result
+            return counted
+
+        def counted_cutoff(first):
+            stats.cutoffs += 1
+            if first:
+                stats.first_move_cutoffs += 1
+
+        player.negamax = count_node(player.negamax)
+        player.expectimax_help = count_node(player.expectimax_help)
+        player.best_leaf = count_leaves(player.best_leaf)
+        player.average_leaf = count_leaves(player.average_leaf)
+        player.expectimax_cutoff = counted_cutoff
+        player.evaluate_position = timed_evaluate
+        player.move_orderer = StatsOrderer(player.move_orderer, self)
+        player.expectimax_cache = CountingDict()
+
+    def uninstall(self, player):
+        for name in ('negamax', 'expectimax_help', 'best_leaf', 'average_leaf', 'expectimax_cutoff',
+                     'evaluate_position'):
+            player.__dict__.pop(name, None)
+        player.move_orderer = player.move_orderer.orderer
+        if self.search == 'alpha_beta':
+            table = player.transposition_table
+            self.table_probes = table.probes - self.table_start[0]
+            self.table_hits = table.hits - self.table_start[1]
+        else:
+            self.table_probes = player.expectimax_cache.probes
+            self.table_hits = player.expectimax_cache.hits
+        player.expectimax_cache = {}
+        if self.root is not None:
+            self.root.__dict__.pop('valid_columns', None)
+        self.total_seconds = time.perf_counter() - self.start
+
+    def finish(self, player, move):
+        """
+        Fill in the results once the search is over and the wrappers are off
+        """
+        self.move = int(move)
+        self.source = player.move_source
+        if self.source == 'search':
+            self.depth = player.search_depth
+            self.score = player.search_score
+            if self.search == 'alpha_beta' and self.root is not None:
+                self.pv = self.principal_variation(player)
+            else:
+                self.pv = [self.move]
+        elif self.source == 'endgame':
+            self.score = player.search_score
+            self.solver_nodes = player.solver.nodes
+            self.pv = [self.move]
+        else:
+            self.pv = [self.move]
+
+    def principal_variation(self, player):
+        """
+        RETURNS:
+        The best moves from the root as far as the transposition table
+        still has them
+        """
+        position = self.root.copy()
+        piece = self.player_number
+        pv = []
+        for _ in range(self.depth or 0):
+            entry = player.transposition_table.probe(position.hash)
+            if entry is None or entry[3] is None or not position.can_play(entry[3]):
+                break
+            pv.append(entry[3])
+            position.make_move(entry[3], piece)
+            if position.game_completed():
+                break
+            piece = 3 - piece
+        return pv
+
+    def to_dict(self):
+        nodes = sum(self.nodes_by_ply)
+        return {
+            'search': self.search,
+            'player': self.player_number,
+            'source': self.source,
+            'move': self.move,
+            'score': self.score if self.score is None or abs(self.score) != float('inf') else str(self.score),
+            'depth': self.depth,
+            'nodes': nodes,
+            'nodes_by_ply': self.nodes_by_ply,
+            'solver_nodes': self.solver_nodes,
+            'cutoffs': self.cutoffs,
+            'first_move_cutoff_rate': self.first_move_cutoffs / self.cutoffs if self.cutoffs else None,
+            'table_probes': self.table_probes,
+            'table_hit_rate': self.table_hits / self.table_probes if self.table_probes else None,
+            'eval_calls': self.eval_calls,
+            'eval_seconds': self.eval_seconds,
+            'movegen_seconds': self.movegen_seconds,
+            'total_seconds': self.total_seconds,
+            'nodes_per_second': nodes / self.total_seconds if self.total_seconds else None,
+            'pv': self.pv,
+        }
+
+    def write(self, sink):
+        """
+        Send the statistics as one JSON line
+
+        INPUTS:
+        sink - a file name to append to, an open text file, or a function
+               taking the line
+        """
+        line = json.dumps(self.to_dict())
+        if callable(sink):
+            sink(line)
+        elif isinstance(sink, str):
+            with open(sink, 'a') as f:
+                f.write(line + '\n')
+        else:
+            sink.write(line + '\n')
+            sink.flush()
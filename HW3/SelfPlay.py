@@ -0,0 +1,285 @@
+# system libs
+import argparse
+import math
+import multiprocessing as mp
+import os
+import random
+import struct
+import time
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Bitboard import ROWS, COLUMNS, CONNECT
+from Player import AIPlayer, RandomPlayer
+from Rules import drop_piece, search_method, won_at
+
+
+# every shard starts with magic, format version, rows, columns and connect,
+# padded to 16 bytes; fixed-size records follow until the end of the file
+SHARD_MAGIC = b'C4SP'
+SHARD_VERSION = 1
+HEADER = struct.Struct('<4sBBBB8x')
+# records per shard before the writer starts the next file
+SHARD_RECORDS = 1 << 20
+# record source of a move: 0 for random or book moves, which have no score
+SOURCES = {'search': 1, 'endgame': 2}
+
+
+def record_dtype(rows=ROWS, columns=COLUMNS):
+    """
+    RETURNS:
+    The numpy dtype of one position record:
+    board - the board before the move, encoded as in Game
+    to_move - the player to move, 1 or 2
+    ply - pieces on the board
+    score - the score of the move for the player to move, NaN when the
+            move was random or came from the book
+    source - where the score came from, see SOURCES; endgame scores are
+             proven wins, losses and draws on the same scale as searched
+             ones
+    result - the winner of the game, 0 for a draw
+    """
+    return np.dtype([
+        ('board', np.int8, (rows, columns)),
+        ('to_move', np.int8),
+        ('ply', np.uint8),
+        ('score', np.float32),
+        ('source', np.int8),
+        ('result', np.int8),
+    ])
+
+
+class ShardWriter:
+    def __init__(self, directory, prefix, rows=ROWS, columns=COLUMNS, connect=CONNECT,
+                 shard_records=SHARD_RECORDS):
+        """
+        Appends records to shards named <prefix>-<n>.shard in directory,
+        starting a new one every shard_records records. Existing shards are
+        never opened for writing, so writers with different prefixes can
+        share a directory
+
+        INPUTS:
+        directory - where the shards go
+        prefix - file name prefix of this writer's shards
+        rows, columns, connect - the board size and line length
+        shard_records - records per shard
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.size = (rows, columns, connect)
+        self.shard_records = shard_records
+        self.file = None
+        self.in_shard = 0
+        self.next_index = 0
+        self.records = 0
+        self.paths = []
+
+    def open_shard(self):
+        self.close()
+        while True:
+            path = os.path.join(self.directory, '{}-{:05d}.shard'.format(self.prefix, self.next_index))
+            self.next_index += 1
+            try:
+                self.file = open(path, 'xb')
+                break
+            except FileExistsError:
+                continue
+        self.file.write(HEADER.pack(SHARD_MAGIC, SHARD_VERSION, *self.size))
+        self.in_shard = 0
+        self.paths.append(path)
+
+    def write(self, records):
+        """
+        INPUTS:
+        records - an array of record_dtype, written in order
+        """
+        start = 0
+        while start < len(records):
+            if self.file is None or self.in_shard == self.shard_records:
+                self.open_shard()
+            count = min(len(records) - start, self.shard_records - self.in_shard)
+            self.file.write(records[start:start + count].tobytes())
+            self.in_shard += count
+            start += count
+        self.records += len(records)
+        # a reader only ever sees whole games
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def open_shard(path):
+    """
+    Memory-map a shard. A record cut short by a writer that is still
+    running or was killed is left out
+
+    RETURNS:
+    (records, (rows, columns, connect)): a read-only array of record_dtype
+    backed by the file, and the board the shard was played on
+    """
+    with open(path, 'rb') as f:
+        magic, version, rows, columns, connect = HEADER.unpack(f.read(HEADER.size))
+    if magic != SHARD_MAGIC or version != SHARD_VERSION:
+        raise ValueError('{} is not a version {} shard'.format(path, SHARD_VERSION))
+    dtype = record_dtype(rows, columns)
+    count = (os.path.getsize(path) - HEADER.size) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype), (rows, columns, connect)
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER.size, shape=(count,)), (rows, columns, connect)
+
+
+def shard_paths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.shard'))
+
+
+def read_batches(directory, batch_size=65536):
+    """
+    Yield the records of every shard in directory as arrays of at most
+    batch_size records. The batches are views of the memory-mapped files,
+    nothing is copied or read before it is used
+
+    RETURNS:
+    A generator of record_dtype arrays
+    """
+    for path in shard_paths(directory):
+        records, _ = open_shard(path)
+        for start in range(0, len(records), batch_size):
+            yield records[start:start + batch_size]
+
+
+def play_recorded(player1, player2, time_limit=None, random_plies=0, rows=ROWS, columns=COLUMNS,
+                  connect=CONNECT):
+    """
+    Play one headless game like Tournament.play_headless and record every
+    position before a move
+
+    INPUTS:
+    player1, player2 - AIPlayer or RandomPlayer objects numbered 1 and 2
+    time_limit - seconds per AI move, None searches to the fixed depth
+    random_plies - moves at the start played at random by both sides, so
+                   games between deterministic players differ
+    rows, columns, connect - the board size and the pieces in a row that win
+
+    RETURNS:
+    An array of record_dtype, one record per move played
+    """
+    players = [player1, player2]
+    board = np.zeros([rows, columns]).astype(np.uint8)
+    records = np.zeros(rows * columns, dtype=record_dtype(rows, columns))
+    current_turn = 0
+    moves = 0
+    while True:
+        current_player = players[current_turn]
+        record = records[moves]
+        record['board'] = board
+        record['to_move'] = current_player.player_number
+        record['ply'] = moves
+        record['score'] = math.nan
+        if moves < random_plies:
+            move = random.choice([col for col in range(columns) if board[0, col] == 0])
+        elif current_player.type == 'ai':
+            method = search_method(players[int(not current_turn)].type, current_player.engine)
+            current_player.search_score = None
+            move = getattr(current_player, method)(board, time_limit)
+            if current_player.move_source in SOURCES and current_player.search_score is not None:
+                record['score'] = current_player.search_score
+                record['source'] = SOURCES[current_player.move_source]
+        else:
+            move = current_player.get_move(board)
+        row = drop_piece(board, int(move), current_player.player_number)
+        moves += 1
+
+        if won_at(board, row, int(move), current_player.player_number, connect):
+            records['result'] = current_player.player_number
+            return records[:moves]
+        if 0 not in board[0]:
+            return records[:moves]
+        current_turn = int(not current_turn)
+
+
+def self_play_worker(task):
+    """
+    Pool task: play a range of games into this worker's own shards. Games
+    whose index is a multiple of random_every put the AI against a
+    RandomPlayer, the rest are AI against AI; the AI alternates colors
+
+    RETURNS:
+    (games, positions) written
+    """
+    worker, first, games, seed, directory, time_limit, random_every, random_plies, size, shard_records = task
+    writer = ShardWriter(directory, '{}-{:03d}'.format(seed, worker), *size, shard_records=shard_records)
+    positions = 0
+    try:
+        for index in range(first, first + games):
+            random.seed(seed + index)
+            np.random.seed((seed + index) % 2 ** 32)
+            players = [AIPlayer(1, rows=size[0], columns=size[1], connect=size[2]),
+                       AIPlayer(2, rows=size[0], columns=size[1], connect=size[2])]
+            if random_every and index % random_every == 0:
+                # the AI side alternates between the random games
+                players[(index // random_every) % 2] = RandomPlayer((index // random_every) % 2 + 1)
+            records = play_recorded(players[0], players[1], time_limit, random_plies, *size)
+            writer.write(records)
+            positions += len(records)
+    finally:
+        writer.close()
+    return games, positions
+
+
+def generate(directory, games, workers=None, seed=0, time_limit=None, random_every=4, random_plies=4,
+             rows=ROWS, columns=COLUMNS, connect=CONNECT, shard_records=SHARD_RECORDS):
+    """
+    Play self-play games across a process pool, every worker
+    streaming its positions into its own shards in directory
+
+    RETURNS:
+    (games, positions, seconds)
+    """
+    os.makedirs(directory, exist_ok=True)
+    workers = workers or mp.cpu_count()
+    # one task per worker, so each writes one stream of shards
+    per_worker, extra = divmod(games, workers)
+    tasks = []
+    first = 0
+    for worker in range(workers):
+        count = per_worker + (worker < extra)
+        if count:
+            tasks.append((worker, first, count, seed, directory, time_limit, random_every, random_plies,
+                          (rows, columns, connect), shard_records))
+        first += count
+    start = time.time()
+    with mp.Pool(len(tasks)) as pool:
+        results = pool.map(self_play_worker, tasks, chunksize=1)
+    return sum(r[0] for r in results), sum(r[1] for r in results), time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record self-play games into memory-mappable shards')
+    parser.add_argument('directory', help='Where the shards go')
+    parser.add_argument('--games', type=int, default=1000, help='Number of games (int)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, default all cores')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first game, also names the shards')
+    parser.add_argument('--time',
+                        type=float,
+                        default=None,
+                        help='Seconds per AI move, default searches to the fixed depth')
+    parser.add_argument('--random-every', type=int, default=4,
+                        help='Every n-th game is against a random player, 0 for never')
+    parser.add_argument('--random-plies', type=int, default=4, help='Random opening moves of every game')
+    parser.add_argument('--shard-records', type=int, default=SHARD_RECORDS, help='Positions per shard')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Board rows (int)')
+    parser.add_argument('--columns', type=int, default=COLUMNS, help='Board columns (int)')
+    parser.add_argument('--connect', type=int, default=CONNECT, help='Pieces in a row that win (int)')
+    args = parser.parse_args()
+
+    games, positions, seconds = generate(args.directory, args.games, args.workers, args.seed, args.time,
+                                         args.random_every, args.random_plies, args.rows, args.columns,
+                                         args.connect, args.shard_records)
+    print('{} games, {} positions in {:.1f}s ({:.0f} positions/s)'.format(
+        games, positions, seconds, positions / max(seconds, 1e-9)))
@@ -0,0 +1,200 @@
+# system libs
+import argparse
+import math
+import multiprocessing as mp
+import random
+import time
+
+# 3rd party libs
+import numpy as np
+
+# Local libs
+from Bitboard import ROWS, COLUMNS, CONNECT
+from Player import AIPlayer, RandomPlayer
+from Rules import drop_piece, search_method, won_at
+
+
+def make_player(name, num, rows=ROWS, columns=COLUMNS, connect=CONNECT, weights=None):
+    if name == 'ai':
+        return AIPlayer(num, rows=rows, columns=columns, connect=connect, weights_path=weights)
+    elif name == 'mcts':
+        return AIPlayer(num, rows=rows, columns=columns, connect=connect, engine='mcts')
+    elif name == 'random':
+        return RandomPlayer(num)
+
+
+def play_headless(player1, player2, time_limit=None, random_plies=0, rows=ROWS, columns=COLUMNS,
+                  connect=CONNECT):
+    """
+    Play one game without a GUI, following the same rules as Game: player1
+    moves first, an AI uses MCTS if that is its engine, otherwise
+    expectimax against a random player and alpha-beta. A full board without a winner is a draw.
+
+    INPUTS:
+    player1, player2 - AIPlayer or RandomPlayer objects numbered 1 and 2
+    time_limit - seconds per AI move, None searches to the fixed depth
+    random_plies - moves at the start played at random by both sides, so
+                   games between deterministic players differ
+    rows, columns, connect - the board size and the pieces in a row that win
+
+    RETURNS:
+    (winner, moves): the winning player number or 0 for a draw, and the
+    number of moves played
+    """
+    players = [player1, player2]
+    board = np.zeros([rows, columns]).astype(np.uint8)
+    current_turn = 0
+    moves = 0
+    while True:
+        current_player = players[current_turn]
+        if moves < random_plies:
+            move = random.choice([col for col in range(columns) if board[0, col] == 0])
+        elif current_player.type == 'ai':
+            method = search_method(players[int(not current_turn)].type, current_player.engine)
+            move = getattr(current_player, method)(board, time_limit)
+        else:
+            move = current_player.get_move(board)
+        row = drop_piece(board, int(move), current_player.player_number)
+        moves += 1
+
+        if won_at(board, row, int(move), current_player.player_number, connect):
+            return current_player.player_number, moves
+        if 0 not in board[0]:
+            return 0, moves
+        current_turn = int(not current_turn)
+
+
+def tournament_game(task):
+    """
+    Pool task: play game number index between the engines named a and b.
+    a moves first in even games and b in odd ones, and each pair of games
+    starts from the same random opening
+
+    RETURNS:
+    (score of a, moves, seconds) where the score is 1, 0.5 or 0
+    """
+    index, a, b, seed, time_limit, random_plies, size, (weights_a, weights_b) = task
+    random.seed(seed + index // 2)
+    np.random.seed((seed + index // 2) % 2 ** 32)
+    a_first = index % 2 == 0
+    if a_first:
+        player1, player2 = make_player(a, 1, *size, weights_a), make_player(b, 2, *size, weights_b)
+    else:
+        player1, player2 = make_player(b, 1, *size, weights_b), make_player(a, 2, *size, weights_a)
+    start = time.time()
+    winner, moves = play_headless(player1, player2, time_limit, random_plies, *size)
+    seconds = time.time() - start
+    if winner == 0:
+        score = 0.5
+    else:
+        score = 1.0 if (winner == 1) == a_first else 0.0
+    return score, moves, seconds
+
+
+def elo(score):
+    """
+    RETURNS:
+    The Elo difference that gives the expected score, +-inf for 1 and 0
+    """
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return 400 * math.log10(score / (1 - score))
+
+
+def wilson_interval(score, n, z=1.96):
+    """
+    RETURNS:
+    (low, high): the Wilson score interval of a mean score over n games,
+    which unlike the normal interval does not shrink to nothing when
+    every game went the same way
+    """
+    center = (score + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * math.sqrt(score * (1 - score) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    # the interval reaches 0 or 1 exactly when the score does, which
+    # rounding would otherwise miss
+    low = 0.0 if score <= 0 else center - half
+    high = 1.0 if score >= 1 else center + half
+    return low, high
+
+
+def summarize(scores, moves, seconds, wall_seconds):
+    """
+    RETURNS:
+    A dict with the win/draw/loss rates of the first engine, its Elo
+    difference with a 95% confidence interval and the move throughput.
+    The Elo estimate takes a score no closer to 0 or 1 than half a game, so
+    a run that won or lost every game still gives a finite one; the
+    interval is not clamped, its far end is then +-inf
+    """
+    n = len(scores)
+    mean = sum(scores) / n
+    low, high = wilson_interval(mean, n)
+
+    def clamped_elo(score):
+        return elo(min(max(score, 0.5 / n), 1 - 0.5 / n))
+    return {
+        'games': n,
+        'win': scores.count(1.0) / n,
+        'draw': scores.count(0.5) / n,
+        'loss': scores.count(0.0) / n,
+        'score': mean,
+        'elo': clamped_elo(mean),
+        'elo_low': elo(low),
+        'elo_high': elo(high),
+        'moves': sum(moves),
+        # moves per second of one core, and of the whole run
+        'moves_per_second': sum(moves) / max(sum(seconds), 1e-9),
+        'moves_per_second_total': sum(moves) / max(wall_seconds, 1e-9),
+    }
+
+
+def run_tournament(a, b, games, workers=None, seed=0, time_limit=None, random_plies=4, rows=ROWS,
+                   columns=COLUMNS, connect=CONNECT, weights_a=None, weights_b=None):
+    """
+    Play games between the engines a and b ('ai', 'mcts' or 'random') across a
+    process pool, alternating who moves first after random_plies random
+    opening moves. weights_a and weights_b are evaluation weights files for
+    an 'ai' engine
+
+    RETURNS:
+    The summarize dict, scored for a
+    """
+    tasks = [(i, a, b, seed, time_limit, random_plies, (rows, columns, connect), (weights_a, weights_b))
+             for i in range(games)]
+    start = time.time()
+    with mp.Pool(workers) as pool:
+        results = pool.map(tournament_game, tasks, chunksize=max(1, games // (8 * (workers or mp.cpu_count()))))
+    wall_seconds = time.time() - start
+    scores, moves, seconds = (list(r) for r in zip(*results))
+    return summarize(scores, moves, seconds, wall_seconds)
+
+
+if __name__ == '__main__':
+    player_types = ['ai', 'mcts', 'random']
+    parser = argparse.ArgumentParser(description='Play headless games between two engines')
+    parser.add_argument('player1', choices=player_types)
+    parser.add_argument('player2', choices=player_types)
+    parser.add_argument('--games', type=int, default=100, help='Number of games (int)')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, default all cores')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first game (int)')
+    parser.add_argument('--time',
+                        type=float,
+                        default=None,
+                        help='Seconds per AI move, default searches to the fixed depth')
+    parser.add_argument('--random-plies', type=int, default=4, help='Random opening moves of every game')
+    parser.add_argument('--rows', type=int, default=ROWS, help='Board rows (int)')
+    parser.add_argument('--columns', type=int, default=COLUMNS, help='Board columns (int)')
+    parser.add_argument('--connect', type=int, default=CONNECT, help='Pieces in a row that win (int)')
+    parser.add_argument('--weights1', default=None, help="Evaluation weights file of player1's ai")
+    parser.add_argument('--weights2', default=None, help="Evaluation weights file of player2's ai")
+    args = parser.parse_args()
+
+    result = run_tournament(args.player1, args.player2, args.games, args.workers, args.seed, args.time,
+                            args.random_plies, args.rows, args.columns, args.connect, args.weights1, args.weights2)
+    print('{} vs {}: {} games'.format(args.player1, args.player2, result['games']))
+    print('win {:.1%}  draw {:.1%}  loss {:.1%}'.format(result['win'], result['draw'], result['loss']))
+    print('elo {:+.0f} (95% {:+.0f} .. {:+.0f})'.format(result['elo'], result['elo_low'], result['elo_high']))
+    print('{} moves, {:.0f} moves/s per core, {:.0f} moves/s total'.format(
+        result['moves'], result['moves_per_second'], result['moves_per_second_total']))
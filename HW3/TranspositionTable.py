@@ -0,0 +1,203 @@
+import struct
+from multiprocessing import shared_memory
+
+# bound types of a stored score
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# rough size of one stored entry in bytes (tuple, key, score and list slot),
+# used to turn the memory cap into a number of slots
+ENTRY_BYTES = 200
+
+
+class TranspositionTable:
+    def __init__(self, size_mb=16):
+        """
+        Two-tier transposition table keyed by zobrist hash
+
+        Every bucket has two slots: a depth-preferred slot that keeps the
+        deepest search of the current game, and an always-replace slot for
+        everything else. The number of buckets is fixed by size_mb, so memory
+        stays bounded however long the table lives.
+
+        INPUTS:
+        size_mb - approximate memory cap of the table in megabytes
+        """
+        self.size_mb = size_mb
+        self.num_buckets = max(1, size_mb * 1024 * 1024 // (2 * ENTRY_BYTES))
+        # entry: (key, depth, flag, score, move, generation)
+        self.slots = [None] * (2 * self.num_buckets)
+        self.generation = 0
+        self.hits = 0
+        self.probes = 0
+
+    def new_search(self):
+        """
+        Age the table so entries of earlier moves can be replaced in the
+        depth-preferred slots
+        """
+        self.generation += 1
+
+    def clear(self):
+        self.slots = [None] * (2 * self.num_buckets)
+        self.generation = 0
+
+    def probe(self, key):
+        """
+        INPUTS:
+        key - the zobrist hash of the position
+
+        RETURNS:
+        (depth, flag, score, move) of the stored entry or None
+        """
+        self.probes += 1
+        index = 2 * (key % self.num_buckets)
+        for entry in (self.slots[index], self.slots[index + 1]):
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1:5]
+        return None
+
+    def store(self, key, depth, flag, score, move):
+        index = 2 * (key % self.num_buckets)
+        entry = (key, depth, flag, score, move, self.generation)
+        deep = self.slots[index]
+        if (deep is None or deep[0] == key or depth >= deep[1]
+                or deep[5] != self.generation):
+            # the old deep entry is still worth keeping one tier down
+            if deep is not None and deep[0] != key:
+                self.slots[index + 1] = deep
+            self.slots[index] = entry
+        else:
+            self.slots[index + 1] = entry
+
+    def best_move(self, key):
+        entry = self.probe(key)
+        if entry is None:
+            return None
+        return entry[3]
+
+    def usage(self):
+        """
+        RETURNS:
+        The fraction of slots that hold an entry
+        """
+        return sum(1 for entry in self.slots if entry is not None) / len(self.slots)
+
+
+# bytes of one SharedTranspositionTable bucket: two slots of two 64-bit
+# words, (key ^ data, data)
+SHARED_BUCKET_BYTES = 32
+# header words: generation, number of buckets
+SHARED_HEADER = 2
+# move field of an entry without a best move
+NO_MOVE = 255
+# set in every stored data word, so an empty slot never matches
+VALID = 1 << 63
+INT = struct.Struct('<i')
+UINT = struct.Struct('<I')
+
+
+class SharedTranspositionTable:
+    def __init__(self, size_mb=16, name=None):
+        """
+        TranspositionTable in multiprocessing.shared_memory, for processes
+        searching the same position at once. It has the same interface and
+        replacement scheme, without a lock: every slot is a data word
+        packing depth, flag, score, move and generation, next to its key
+        xor that word. A slot torn by two writers racing no longer matches
+        any key, so a reader sees a whole entry or a miss.
+
+        Scores are stored as 32-bit integers, like the negamax scores.
+
+        INPUTS:
+        size_mb - memory of the table in megabytes, when creating it
+        name - the shared memory block of an existing table to attach to;
+               only the process that created the table ages or clears it
+        """
+        self.size_mb = size_mb
+        self.owner = name is None
+        if self.owner:
+            num_buckets = max(1, size_mb * 1024 * 1024 // SHARED_BUCKET_BYTES)
+            size = 8 * SHARED_HEADER + SHARED_BUCKET_BYTES * num_buckets
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.words = self.shm.buf.cast('Q')
+            self.words[1] = num_buckets
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.words = self.shm.buf.cast('Q')
+        self.name = self.shm.name
+        self.num_buckets = self.words[1]
+        self.hits = 0
+        self.probes = 0
+
+    @property
+    def generation(self):
+        return self.words[0]
+
+    def new_search(self):
+        if self.owner:
+            self.words[0] = (self.words[0] + 1) & 0xff
+
+    def clear(self):
+        if self.owner:
+            start = 8 * SHARED_HEADER
+            self.shm.buf[start:] = bytes(len(self.shm.buf) - start)
+            self.words[0] = 0
+
+    def probe(self, key):
+        self.probes += 1
+        words = self.words
+        index = SHARED_HEADER + 4 * (key % self.num_buckets)
+        for slot in (index, index + 2):
+            data = words[slot + 1]
+            if data and words[slot] ^ data == key:
+                self.hits += 1
+                move = data >> 42 & 0xff
+                return (data >> 32 & 0xff, data >> 40 & 0x3, INT.unpack(UINT.pack(data & 0xffffffff))[0],
+                        None if move == NO_MOVE else move)
+        return None
+
+    def store(self, key, depth, flag, score, move):
+        words = self.words
+        generation = words[0]
+        data = (VALID | generation << 50 | (NO_MOVE if move is None else move) << 42 | flag << 40
+                | min(depth, 255) << 32 | UINT.unpack(INT.pack(score))[0])
+        index = SHARED_HEADER + 4 * (key % self.num_buckets)
+        deep_data = words[index + 1]
+        deep_key = words[index] ^ deep_data
+        if (not deep_data or deep_key == key or depth >= deep_data >> 32 & 0xff
+                or deep_data >> 50 & 0xff != generation):
+            # the old deep entry is still worth keeping one tier down
+            if deep_data and deep_key != key:
+                words[index + 2] = deep_key ^ deep_data
+                words[index + 3] = deep_data
+            words[index] = key ^ data
+            words[index + 1] = data
+        else:
+            words[index + 2] = key ^ data
+            words[index + 3] = data
+
+    def best_move(self, key):
+        entry = self.probe(key)
+        if entry is None:
+            return None
+        return entry[3]
+
+    def usage(self):
+        """
+        RETURNS:
+        The fraction of slots that hold an entry
+        """
+        data = self.words[SHARED_HEADER + 1::2]
+        return sum(1 for word in data if word) / len(data)
+
+    def close(self):
+        """
+        Detach from the table, and free it if this process created it
+        """
+        self.words.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()